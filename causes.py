@@ -1,52 +1,91 @@
-import csv
-import sys
-import matplotlib.pyplot as plt
-import numpy
-from numpy.core.fromnumeric import size
-
-
-def add_cat(table, category, ndeaths, nmentions):
-    """Add a category to the table."""
-    (odeaths, omentions) = table.get(category, (0, 0))
-    table[category] = (odeaths + int(ndeaths), omentions + int(nmentions))
-
-
-def get_data(fname):
-    """Parse fname and return the condition and category data."""
-    conditions = {}
-    categories = {}
-
-    # open and read the CSV file
-    with open(fname, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        for row in reader:
-            as_of, wk_start, wk_end, group, year, month, state, category, condition, icd10, age, ndeaths, mentions, flag = row
-
-            # only consider "all ages"
-            if age.lower() != "all ages":
-                continue
+#!/usr/bin/env python3
 
-            # skip rows with zero deaths
-            if not ndeaths:
-                continue
+"""
+Plot COVID-19 death certificate comorbidities from the CDC data at
+https://data.cdc.gov/NCHS/Conditions-Contributing-to-COVID-19-Deaths-by-Stat/hk9y-quqm
+"""
 
-            # add national totals, disregard state totals 
-            if state != "United States":
+import os
+import re
+import sys
+import argparse
+
+import covid
+
+
+# CSV columns and the names used for them in the frame
+COLUMNS = {
+    "Group": "group",
+    "Year": "year",
+    "Month": "month",
+    "State": "state",
+    "Condition Group": "category",
+    "Condition": "condition",
+    "Age Group": "age",
+    "COVID-19 Deaths": "deaths",
+    "Number of Mentions": "mentions"
+}
+KEYS = ["group", "year", "month", "state", "category", "condition", "age"]
+VALUES = ["deaths", "mentions"]
+
+ALL_AGES = "All Ages"
+NATIONAL = "United States"
+BY_TOTAL = "By Total"
+
+DPI = 100
+
+
+def load(fname):
+    """Read fname into a frame of categorical keys and numeric counts."""
+    import pandas
+    with covid.stage("load") as record:
+        frame = pandas.read_csv(fname, usecols=list(COLUMNS),
+                                dtype={k: "Int64" if COLUMNS[k] in ("year", "month") else "category"
+                                       for k in COLUMNS if COLUMNS[k] in KEYS},
+                                thousands=",")
+        frame = frame.rename(columns=COLUMNS)
+        frame["deaths"] = pandas.to_numeric(frame["deaths"], errors="coerce")
+        frame["mentions"] = pandas.to_numeric(frame["mentions"], errors="coerce").fillna(0)
+        record["rows"] = len(frame)
+    # skip rows with suppressed deaths
+    return frame[frame["deaths"].notna()]
+
+
+def aggregate(frame, by, group=BY_TOTAL, state=None, age=None, **select):
+    """Sum deaths and mentions over the rows of one group (total, yearly or monthly),
+    grouped by the given columns. Each keyword selects a value or list of values of a column;
+    state and age default to the national all-age rows unless grouped by."""
+    # the national and all-age rows already total the others
+    if state is None and "state" not in by:
+        state = NATIONAL
+    if age is None and "age" not in by:
+        age = ALL_AGES
+    select.update(state=state, age=age)
+    with covid.stage("aggregate", rows=len(frame)):
+        mask = frame["group"] == group
+        for column, value in select.items():
+            if value is None:
                 continue
+            if isinstance(value, str):
+                mask &= frame[column] == value
+            else:
+                mask &= frame[column].isin(value)
+        return frame[mask].groupby(list(by), observed=True)[VALUES].sum().astype("int64")
 
-            # add total totals, disregard yearly and montly totals
-            if group != "By Total":
-                continue
 
-            try:
-                ndeaths = int(ndeaths)
-            except ValueError:
-                continue
+def table(totals):
+    """Convert aggregated totals to a {key: (deaths, mentions)} table."""
+    return {k: (d, m) for k, d, m in zip(totals.index.tolist(),
+                                         totals["deaths"].tolist(),
+                                         totals["mentions"].tolist())}
 
-            add_cat(conditions, condition, ndeaths, mentions)
-            add_cat(categories, category, ndeaths, mentions)
 
-    return conditions, categories
+def get_data(fname):
+    """Parse fname and return the national all-age condition and category data."""
+    frame = load(fname)
+    conditions = aggregate(frame, ["condition"])
+    categories = aggregate(frame, ["category"])
+    return table(conditions), table(categories)
 
 
 def make_totals(data, divisor=1):
@@ -73,7 +112,11 @@ def abbrev(val):
     return f"{val:0.0f}"
 
 
-def plot_deaths(table):
+def plot_deaths(table, fname=None, title=None, key=None):
+    """Plot the table, then display it or write it to fname (with its render key)."""
+    import numpy
+    plt = covid.pyplot(interactive=fname is None)
+
     # sort rows by deaths (descending)
     table_sorted = sorted([(v, k) for k, v in table.items()], reverse=True)
     data = []
@@ -104,30 +147,109 @@ def plot_deaths(table):
     ax.invert_yaxis()  # labels read top-to-bottom
 
     # add labels
-    ax.set_title('Death Certificate Comorbidities')
+    ax.set_title(title or 'Death Certificate Comorbidities')
     ax.set_xlabel('Total Mentions (Thousands)')
 
-    # add per-row data labels
+    # add per-row data labels, just past the end of each bar
+    pad = data[:, 1].max() / div * 0.015
     for i in range(len(data)):
         f = data[i, 1]  # full count
         m = data[i, 0]  # mentions
         lbl = abbrev(m) + " : " + abbrev(f - m)
-        plt.text(f / div + 10, i + 0.25, lbl, size="small")
+        plt.text(f / div + pad, i + 0.25, lbl, size="small")
 
     x1, x2, y1, y2 = plt.axis()
     plt.axis((x1, x2 * 1.1, y1, y2))
     plt.subplots_adjust(left=0.5, right=0.99)
-    plt.show()
-    sys.exit(-1)
+    if fname is None:
+        plt.show()
+    else:
+        plt.savefig(fname, dpi=DPI, metadata=covid.render_metadata(key) if key else None)
+        plt.close(fig)
+
+
+def slice_fname(outdir, state, age):
+    """Return the chart file name for a state and age group."""
+    name = "_".join(re.sub(r'[^0-9A-Za-z]+', '-', x).strip('-') for x in (state, age))
+    return os.path.join(outdir, f"causes_{name}.png")
+
+
+def render_slice(job):
+    """Render one (table, fname, title, key) job; run in a worker process."""
+    table, fname, title, key = job
+    plot_deaths(table, fname, title, key)
+    return fname
+
+
+def plot_batch(frame, states, ages, by, outdir, group=BY_TOTAL, jobs=None):
+    """Plot every state x age slice of frame to a file in outdir, rendering in parallel."""
+    import concurrent.futures
+    if states == ["ALL"]:
+        states = list(frame["state"].cat.categories)
+    if ages == ["ALL"]:
+        ages = list(frame["age"].cat.categories)
+    # one pass over the frame for every slice
+    totals = table(aggregate(frame, ["state", "age", by], group=group, state=states, age=ages))
+    slices = {}
+    for (state, age, key), counts in totals.items():
+        slices.setdefault((state, age), {})[key] = counts
+    work = []
+    for state in states:
+        for age in ages:
+            if (state, age) not in slices:
+                print("no data for", state, age)
+                continue
+            title = f"Death Certificate Comorbidities ({state}, {age})"
+            fname = slice_fname(outdir, state, age)
+            key = covid.render_key(plot_deaths, slices[state, age], title, DPI)
+            # skip charts already rendered from the same data
+            if not covid.rendered(fname, key):
+                work.append((slices[state, age], fname, title, key))
+    os.makedirs(outdir, exist_ok=True)
+    with covid.stage("render", rows=len(work)), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for fname in pool.map(render_slice, work):
+            covid.count_render("rebuilt")
+            print(fname)
 
 
 if __name__ == "__main__":
-    # download causes.csv from
-    # https://data.cdc.gov/NCHS/Conditions-Contributing-to-COVID-19-Deaths-by-Stat/hk9y-quqm
-    conditions, categories = get_data(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Plot death certificate comorbidities.")
+    parser.add_argument('fname', metavar='causes.csv', type=str,
+                        help='CSV file from https://data.cdc.gov/NCHS/Conditions-Contributing-to-COVID-19-Deaths-by-Stat/hk9y-quqm')
+
+    parser.add_argument('--by', type=str, nargs='+', choices=KEYS[1:],
+                        help='print deaths and mentions grouped by these columns')
+    parser.add_argument('--group', type=str, default=BY_TOTAL,
+                        help='group of rows to aggregate ("By Total", "By Year" or "By Month")')
+    parser.add_argument('--state', type=str, nargs='+', help='restrict to these states')
+    parser.add_argument('--age', type=str, nargs='+', help='restrict to these age groups')
+    parser.add_argument('--outdir', metavar='DIR', type=str,
+                        help='write one chart per --state x --age slice (ALL for every value) to DIR')
+    parser.add_argument('--categories', action='store_true', help='chart condition groups, not conditions')
+    parser.add_argument('--jobs', type=int, help='render charts in N processes')
+    covid.add_profile_argument(parser)
+
+    args = parser.parse_args()
+    covid.profile(args.profile)
+
+    if args.by:
+        totals = aggregate(load(args.fname), args.by, group=args.group,
+                           state=args.state, age=args.age)
+        print(totals.to_csv(), end="")
+        sys.exit(0)
+
+    if args.outdir:
+        plot_batch(load(args.fname), args.state or [NATIONAL], args.age or [ALL_AGES],
+                   "category" if args.categories else "condition", args.outdir,
+                   group=args.group, jobs=args.jobs)
+        sys.exit(0)
+
+    conditions, categories = get_data(args.fname)
 
     # plot_example()
-    plot_deaths(conditions)
+    with covid.stage("plot"):
+        plot_deaths(conditions)
 
     # percents = make_percents(conditions)
     # plot_data(
@@ -1,12 +1,128 @@
 import os
+import sys
+import csv
+import json
 import time
+import atexit
+import datetime
 import pathlib
-import urllib.request
-import subprocess
+import contextlib
+
+
+# host:port of the resident data service (service.py)
+SERVICE = os.environ.get("COVID_SERVICE", "127.0.0.1:8765")
+
+EPOCH = datetime.date(1970, 1, 1)
+OPEN = 2**31 - 1  # end day of an open interval
+
+
+def peak_rss_mb(children=False):
+    """Return the peak resident set size in MB of this process, or of its largest
+    child (ru_maxrss is KB on Linux, bytes on macOS)."""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+class Profile:
+    """Wall time, peak RSS growth and row rates for named stages, plus counters."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.counters = {}
+        self.path = []
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        """Time the enclosed block. Set record["rows"] inside it to report a row rate."""
+        self.path.append(name)
+        record = {"stage": "/".join(self.path)}
+        if rows is not None:
+            record["rows"] = rows
+        start = time.perf_counter()
+        peak = peak_rss_mb()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            # how far the stage raised the process's peak: 0 if it stayed below earlier stages
+            record["peak_rss_growth_mb"] = round(peak_rss_mb() - peak, 1)
+            if record.get("rows") and record["seconds"]:
+                record["rows_per_second"] = round(record["rows"] / record["seconds"], 1)
+            self.stages.append(record)
+            self.path.pop()
+
+    def count(self, name, n=1):
+        """Add n to a named counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {
+            "argv": sys.argv,
+            "seconds": round(time.perf_counter() - self.start, 6),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "children_peak_rss_mb": round(peak_rss_mb(children=True), 1),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+    def write(self, dest):
+        """Write the JSON report to dest, or stderr for "-"."""
+        if dest == "-":
+            json.dump(self.report(), sys.stderr, indent=1)
+            print(file=sys.stderr)
+        else:
+            with open(dest, "w") as fd:
+                json.dump(self.report(), fd, indent=1)
+
+
+PROFILE = Profile()
+stage = PROFILE.stage
+count = PROFILE.count
+
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='-',
+                        help='write a JSON report of stage timings and memory to FILE (default stderr)')
+
+
+def profile(dest):
+    """Write the profile report to dest when the process exits, if dest is set."""
+    if dest:
+        atexit.register(PROFILE.write, dest)
+
+
+def query(path, **params):
+    """Query the resident data service. Return the decoded JSON response,
+    or None if the service isn't running or can't answer."""
+    import http.client
+    import urllib.parse
+    host, port = SERVICE.rsplit(":", 1)
+    params = {k: v for k, v in params.items() if v is not None}
+    conn = http.client.HTTPConnection(host, int(port), timeout=600)
+    try:
+        conn.request("GET", path + "?" + urllib.parse.urlencode(params, doseq=True))
+        response = conn.getresponse()
+        body = response.read()
+    except (OSError, http.client.HTTPException):
+        # nothing listening, or something other than the service
+        return None
+    finally:
+        conn.close()
+    if response.status != 200:
+        print("service:", response.status, body.decode(errors="replace"))
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        print("service: response is not JSON")
+        return None
 
 
 def get_http(url, dest):
     """Retrieve a file via http"""
+    import urllib.request
     print("HTTP", url)
     if not os.path.exists(dest):
         return urllib.request.urlretrieve(url, dest)
@@ -14,35 +130,329 @@ def get_http(url, dest):
 
 def get_curl(url, dest):
     """Retrieve a file via curl"""
+    import subprocess
     print("CURL", url)
     subprocess.run(["curl", url, "-o", dest], check=True)
 
 
+def fresh(dest, shelf_life=None):
+    """Return True if dest exists and is younger than shelf_life seconds
+    (or exists at all if shelf_life is None)."""
+    dest_info = pathlib.Path(dest)
+    if not dest_info.exists():
+        return False
+    if shelf_life is None:
+        print(dest, "already exists.")
+        return True
+    age = time.time() - dest_info.stat().st_ctime
+    if age < shelf_life:
+        print(dest, ": {0:0.1f}".format(age), "<", shelf_life)
+        return True
+    print(dest, ": {0:0.1f}".format(age), ">", shelf_life)
+    return False
+
+
 def download(url, dest, shelf_life=None):
     """Download the URL to the destination."""
-    dest_tmp = dest
-    dest_info = pathlib.Path(dest)
-    if dest_info.exists():
-        if shelf_life is None:
-            print(dest, "already exists.")
-            return
-        age = time.time() - dest_info.stat().st_ctime
-        if age < shelf_life:
-            print(dest, ": {0:0.1f}".format(age), "<", shelf_life)
-            return
-        else:
-            print(dest, ": {0:0.1f}".format(age), ">", shelf_life)
-            dest_tmp = dest + ".tmp"
+    if fresh(dest, shelf_life):
+        return
+    dest_tmp = dest + ".tmp" if os.path.exists(dest) else dest
     if get_http(url, dest_tmp):
         if dest_tmp != dest:
             os.rename(dest_tmp, dest)
 
 
+def stream(url, dest, shelf_life=None, chunk_size=1 << 16, depth=64, timeout=60):
+    """Yield the bytes of the URL in chunks while saving them to the destination,
+    or read the destination if it is fresh. A thread downloads into a queue of at
+    most depth chunks, so the caller can parse while the download continues.
+    A connection that stalls for timeout seconds fails the download."""
+    import queue
+    import tempfile
+    import threading
+    import urllib.request
+    if fresh(dest, shelf_life):
+        with open(dest, "rb") as fd:
+            while chunk := fd.read(chunk_size):
+                yield chunk
+        return
+
+    chunks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        """Queue an item unless the caller has stopped reading; return False if it has."""
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        # a temporary file of its own, so concurrent fetches of dest don't clash
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(dest)),
+                                          prefix=os.path.basename(dest) + ".", delete=False)
+        try:
+            with tmp, urllib.request.urlopen(url, timeout=timeout) as response:
+                while chunk := response.read(chunk_size):
+                    tmp.write(chunk)
+                    if not put(chunk):
+                        return
+            # the temporary file is private; give dest the mode a plain open would
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp.name, 0o666 & ~umask)
+            os.replace(tmp.name, dest)
+            put(b"")
+        except Exception as e:
+            put(e)
+        finally:
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+
+    print("HTTP", url)
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                break
+            count("bytes downloaded", len(chunk))
+            yield chunk
+    finally:
+        # also when the caller stops early: the thread gives up and removes its file
+        stop.set()
+        thread.join()
+
+
+def lines(chunks, encoding="utf-8"):
+    """Split a stream of byte chunks into lines of text, keeping the line ends."""
+    import codecs
+    decoder = codecs.getincrementaldecoder(encoding)()
+    rest = ""
+    for chunk in chunks:
+        *complete, rest = (rest + decoder.decode(chunk)).split("\n")
+        for line in complete:
+            yield line + "\n"
+    rest += decoder.decode(b"", final=True)
+    if rest:
+        yield rest
+
+
 def index(lst):
     """Return a dictionary of index locations."""
     return {i: x for x, i in enumerate(lst)}
 
 
+def day_number(date):
+    """Return the number of days between the epoch and a date."""
+    return (date - EPOCH).days
+
+
+class EventIndex:
+    """Sorted index of event intervals keyed by area and day number."""
+
+    def __init__(self, events):
+        """Index (area, start, end) triples; an end of None is open."""
+        import numpy
+        events = list(events)
+        self.areas = list(sorted(set(e[0] for e in events)))
+        self.area_idx = index(self.areas)
+        area = numpy.array([self.area_idx[e[0]] for e in events], dtype=numpy.int32)
+        start = numpy.array([day_number(e[1]) for e in events], dtype=numpy.int32)
+        end = numpy.array([OPEN if e[2] is None else day_number(e[2]) for e in events],
+                          dtype=numpy.int32)
+        order = numpy.lexsort((start, area))
+        self.area = area[order]
+        self.start = start[order]
+        self.end = end[order]
+        # offsets of each area's events within the sorted arrays
+        self.bounds = numpy.searchsorted(self.area, numpy.arange(len(self.areas) + 1))
+
+    def __len__(self):
+        return len(self.area)
+
+    def window(self, date_first, date_last):
+        """Return (area index, start offset, end offset) arrays for every event
+        overlapping [date_first, date_last], in days after date_first.
+        Open ends are returned as -1."""
+        import numpy
+        first = day_number(date_first)
+        last = day_number(date_last)
+        # each area's events are sorted by start: those starting by last are a prefix
+        lo = self.bounds[:-1]
+        hi = [a + numpy.searchsorted(self.start[a:b], last, side="right")
+              for a, b in zip(self.bounds[:-1], self.bounds[1:])]
+        hit = numpy.concatenate([numpy.arange(a, b) for a, b in zip(lo, hi)] +
+                                [numpy.zeros(0, dtype=numpy.int64)])
+        hit = hit[self.end[hit] >= first]
+        end = self.end[hit] - first
+        end[self.end[hit] == OPEN] = -1
+        return self.area[hit], self.start[hit] - first, end
+
+
+def read_events(fname):
+    """Read an area,start,end CSV file of ISO dates into an EventIndex."""
+    events = []
+    with open(fname, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            end = row['end'] or None
+            events.append((row['area'],
+                           datetime.date.fromisoformat(row['start']),
+                           end and datetime.date.fromisoformat(end)))
+    return EventIndex(events)
+
+
+def pyplot(interactive=True):
+    """Import matplotlib.pyplot on first use, selecting the Agg backend when not interactive."""
+    import matplotlib
+    if not interactive:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def axis_pixels(ax, dpi=None):
+    """Return the width of an axis in pixels, when saved at dpi."""
+    width = ax.get_window_extent().width
+    if dpi is not None:
+        width *= dpi / ax.figure.dpi
+    return max(1, int(width))
+
+
+def downsample(x, y, buckets, log=False):
+    """Reduce a series sorted by x to the first, minimum, maximum and last point of
+    each of the given number of equal-width buckets of x (of log x with log), so that
+    peaks survive. NaN (or a masked value) is kept once per bucket so that gaps still break the line.
+    x must be positive with log."""
+    import numpy
+    x = numpy.asarray(x)
+    # masked values become NaN
+    y = numpy.ma.filled(numpy.ma.asarray(y, dtype=numpy.float64), numpy.nan)
+    # uniform x fits in the buckets already; log buckets may still be crowded at the far end
+    if len(x) <= 4 * (1 if log else buckets):
+        return x, y
+    pos = numpy.log(x) if log else x.astype(numpy.float64)
+    span = pos[-1] - pos[0]
+    if not span > 0:
+        return x, y
+    bucket = numpy.minimum((pos - pos[0]) * buckets // span, buckets - 1).astype(numpy.int64)
+    first = numpy.flatnonzero(numpy.r_[True, bucket[1:] != bucket[:-1]])
+    last = numpy.r_[first[1:] - 1, len(x) - 1]
+    # sort each bucket by value (NaN last) to find its extremes
+    missing = numpy.isnan(y)
+    order = numpy.lexsort((numpy.where(missing, numpy.inf, y), bucket))
+    valid = numpy.add.reduceat(~missing, first)
+    low = order[first]
+    high = order[first + numpy.maximum(valid, 1) - 1]
+    gap = numpy.flatnonzero(missing)
+    # the first NaN of each bucket that has one
+    gap = gap[numpy.r_[True, bucket[gap[1:]] != bucket[gap[:-1]]]] if len(gap) else gap
+    keep = numpy.unique(numpy.concatenate((first, last, low[valid > 0], high[valid > 0], gap)))
+    count("points plotted", len(keep))
+    count("points dropped", len(x) - len(keep))
+    return x[keep], y[keep]
+
+
+RENDER_KEY = "RenderKey"  # PNG text entry holding the hash of a chart's inputs
+RENDERS = {}
+
+
+def _hash_update(h, x):
+    """Add x to hash h: arrays by type, shape and bytes, containers item by item,
+    anything else by repr."""
+    if type(x).__module__.startswith("numpy") and hasattr(x, "tobytes"):
+        import numpy
+        if numpy.ma.isMaskedArray(x):
+            _hash_update(h, numpy.ma.getmaskarray(x))
+            x = x.filled(0)
+        h.update(f"{x.dtype}{x.shape}".encode())
+        h.update(numpy.ascontiguousarray(x).tobytes())
+    elif isinstance(x, (list, tuple)):
+        h.update(f"{type(x).__name__}{len(x)}".encode())
+        for item in x:
+            _hash_update(h, item)
+    elif isinstance(x, dict):
+        _hash_update(h, list(x.items()))
+    else:
+        h.update(repr(x).encode())
+
+
+def render_key(func, *inputs):
+    """Return a hash of a chart's inputs, of the source of the module that plots it
+    and of this module, and of the matplotlib version."""
+    import hashlib
+    import matplotlib
+    h = hashlib.sha256()
+    for fname in dict.fromkeys([sys.modules[func.__module__].__file__, __file__]):
+        with open(fname, "rb") as fd:
+            h.update(fd.read())
+    h.update(matplotlib.__version__.encode())
+    for x in inputs:
+        _hash_update(h, x)
+    return h.hexdigest()
+
+
+def png_text(fname):
+    """Return the text entries before the image data of a PNG file, or {}."""
+    import struct
+    text = {}
+    try:
+        with open(fname, "rb") as fd:
+            if fd.read(8) != b"\x89PNG\r\n\x1a\n":
+                return text
+            while True:
+                head = fd.read(8)
+                if len(head) < 8:
+                    break
+                length, kind = struct.unpack(">I4s", head)
+                if kind in (b"IDAT", b"IEND"):
+                    break
+                data = fd.read(length + 4)[:length]
+                if kind == b"tEXt":
+                    key, _, value = data.partition(b"\0")
+                    text[key.decode("latin1")] = value.decode("latin1")
+    except OSError:
+        pass
+    return text
+
+
+def _render_report():
+    print(f"charts: {RENDERS.get('rebuilt', 0)} rebuilt, {RENDERS.get('reused', 0)} reused")
+
+
+def rendered(fname, key):
+    """Return True if fname was rendered from inputs with this key, counting it as reused."""
+    if png_text(fname).get(RENDER_KEY) != key:
+        return False
+    count_render("reused")
+    return True
+
+
+def count_render(kind, n=1):
+    """Count n charts as "rebuilt" or "reused", for the report at exit and --profile."""
+    if not RENDERS:
+        atexit.register(_render_report)
+    RENDERS[kind] = RENDERS.get(kind, 0) + n
+    count("charts " + kind, n)
+
+
+def render_metadata(key):
+    """Return the savefig metadata recording a render key."""
+    return {RENDER_KEY: key}
+
+
+def savefig(plt, fname, key, **kwargs):
+    """Save the current figure with its render key, counting it as rebuilt."""
+    plt.savefig(fname, metadata=render_metadata(key), **kwargs)
+    count_render("rebuilt")
+
+
 def add_ticks(plt, nticks: int, series: list, labels: list):
     locs = []
     lbls = []
@@ -8,8 +8,12 @@ https://healthdata.gov/dataset/covid-19-estimated-patient-impact-and-hospital-ca
 import sys
 import argparse
 import csv
-import numpy
-import matplotlib.pyplot as plt
+import datetime
+
+import covid
+
+
+STORE_METRICS = ["HHS_INPATIENT", "HHS_BEDS"]
 
 
 def read_data(fname):
@@ -33,8 +37,25 @@ def add_ticks(plt, nticks: int, series: list, labels: list):
     plt.xticks(locs, lbls)
 
 
+def area_code(state):
+    """Return the OxCGRT code of a state ("CW" is country-wide)."""
+    return "USA" if state == "CW" else "US_" + state
+
+
+def store_data(path, states, dates, arr, filled):
+    """Write inpatient and bed counts to the shared store, keyed by OxCGRT code."""
+    import numpy
+    import store
+    values = numpy.where(filled[:, :, None], arr, numpy.nan).transpose(0, 2, 1)
+    store.Store(path).put([area_code(s) for s in states], STORE_METRICS,
+                          [datetime.date.fromisoformat(d) for d in dates], values)
+
+
 def estimate_inpatient(args):
-    data = read_data(args.fname)
+    import numpy
+    with covid.stage("read") as record:
+        data = read_data(args.fname)
+        record["rows"] = len(data) - 1
 
     # heading = data[0]
     data = data[1:]
@@ -44,13 +65,20 @@ def estimate_inpatient(args):
     dates_idx = index(dates)
 
     arr = numpy.zeros((len(states), len(dates), 2), dtype=numpy.float32)
+    filled = numpy.zeros((len(states), len(dates)), dtype=bool)
+
+    with covid.stage("normalize", rows=len(data)):
+        for row in data:
+            state = row[0]
+            date = row[1]
+            use = float(row[2].replace(',', ''))
+            beds = float(row[8].replace(',', ''))
+            arr[states_idx[state], dates_idx[date]] = [use, beds]
+            filled[states_idx[state], dates_idx[date]] = True
 
-    for row in data:
-        state = row[0]
-        date = row[1]
-        use = float(row[2].replace(',', ''))
-        beds = float(row[8].replace(',', ''))
-        arr[states_idx[state], dates_idx[date]] = [use, beds]
+    if args.store:
+        with covid.stage("store"):
+            store_data(args.store, states, dates, arr, filled)
 
     if args.state is None:
         patients = numpy.sum(arr, axis=0)
@@ -61,25 +89,31 @@ def estimate_inpatient(args):
     for pair in zip(dates, pct):
         print(pair)
 
-    fig, ax = plt.subplots()
-    ax.set_ylabel('% COVID admissions')
-    if args.state is None:
-        ax.set_title('All States')
-    else:
-        ax.set_title('State = {0:s}'.format(args.state.upper()))
-    ax.plot(range(len(dates)), pct)
-    add_ticks(plt, 4, range(len(dates)), dates)
-    ax.axvline(x=dates_idx['2020-11-15'], c='r', linewidth=1)
-    plt.show()
+    with covid.stage("plot"):
+        plt = covid.pyplot()
+        fig, ax = plt.subplots()
+        ax.set_ylabel('% COVID admissions')
+        if args.state is None:
+            ax.set_title('All States')
+        else:
+            ax.set_title('State = {0:s}'.format(args.state.upper()))
+        ax.plot(range(len(dates)), pct)
+        add_ticks(plt, 4, range(len(dates)), dates)
+        ax.axvline(x=dates_idx['2020-11-15'], c='r', linewidth=1)
+        plt.show()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Plot COVID hospital admissions.")
     parser.add_argument('--interactive', action='store_true', help='display charts interactively')
     parser.add_argument('--state', type=str, help='State to plot')
+    parser.add_argument('--store', metavar='DIR', type=str, help='write the series to the shared store')
     parser.add_argument('fname', metavar='STATS.csv', type=str,
                         help='CSV file from https://healthdata.gov/dataset/covid-19-estimated-patient-impact-and-hospital-capacity-state')
 
+    covid.add_profile_argument(parser)
+
     args = parser.parse_args()
+    covid.profile(args.profile)
 
     estimate_inpatient(args)
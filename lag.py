@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Lagged cross-correlation between policy and outcome series in the shared
+store (see store.py): how many days after OxCGRT stringency changes do
+deaths or hospital occupancy move.
+"""
+
+import argparse
+
+import covid
+
+
+POLICY_PREFIX = "OXCGRT_"
+MIN_OVERLAP = 30  # fewest days in common for a correlation
+
+
+def cross(a, b, nfft):
+    """Return sum_t a[..., t] * b[..., t + k] for every lag k by FFT, for every pair
+    of rows of a (p x n) and b (o x n): a (p x o x nfft) array, lag k at index k mod nfft."""
+    import numpy
+    fa = numpy.fft.rfft(a, nfft)
+    fb = numpy.fft.rfft(b, nfft)
+    return numpy.fft.irfft(numpy.conj(fa)[:, None, :] * fb[None, :, :], nfft)
+
+
+def correlate(x, y, max_lag, min_overlap=MIN_OVERLAP):
+    """Return the Pearson correlation of each policy row of x (p x days) with each
+    outcome row of y (o x days) shifted by -max_lag..max_lag days, as a
+    (p x o x lags) array, with the number of days in common. Positive lags
+    compare the outcome with the policy that many days earlier. Only days where
+    both series are present count (NaN is missing); lags with fewer than
+    min_overlap such days are NaN."""
+    import numpy
+    mx = ~numpy.isnan(x)
+    my = ~numpy.isnan(y)
+    # standardise first, so that the sums below stay well conditioned;
+    # rows without any data become zeros and correlate as NaN below
+    cx = numpy.maximum(mx.sum(axis=1, keepdims=True), 1)
+    cy = numpy.maximum(my.sum(axis=1, keepdims=True), 1)
+    x = numpy.where(mx, x, 0)
+    y = numpy.where(my, y, 0)
+    x = numpy.where(mx, x - x.sum(axis=1, keepdims=True) / cx, 0)
+    y = numpy.where(my, y - y.sum(axis=1, keepdims=True) / cy, 0)
+    x /= numpy.maximum(numpy.sqrt((x * x).sum(axis=1, keepdims=True) / cx), 1e-12)
+    y /= numpy.maximum(numpy.sqrt((y * y).sum(axis=1, keepdims=True) / cy), 1e-12)
+    mx = mx.astype(numpy.float64)
+    my = my.astype(numpy.float64)
+
+    # without wrap-around for lags up to the series length; longer lags
+    # have no days in common
+    nfft = 1 << int(2 * x.shape[1] - 1).bit_length()
+    lags = numpy.arange(-max_lag, max_lag + 1)
+    inside = numpy.abs(lags) < x.shape[1]
+    lags = lags[inside]
+    n = numpy.round(cross(mx, my, nfft)[..., lags])
+    sx = cross(x, my, nfft)[..., lags]
+    sy = cross(mx, y, nfft)[..., lags]
+    sxx = cross(x * x, my, nfft)[..., lags]
+    syy = cross(mx, y * y, nfft)[..., lags]
+    sxy = cross(x, y, nfft)[..., lags]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        cov = sxy - sx * sy / n
+        var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+        r = cov / numpy.sqrt(var)
+    r[(n < min_overlap) | ~(var > 1e-9)] = numpy.nan
+    shape = (x.shape[0], y.shape[0], len(inside))
+    rv = numpy.full(shape, numpy.nan)
+    rv[..., inside] = numpy.clip(r, -1, 1)
+    days = numpy.zeros(shape, dtype=numpy.int64)
+    days[..., inside] = n
+    return rv, days
+
+
+def correlate_area(job):
+    """Correlate the series of one area; run in a worker process."""
+    area, x, y, max_lag, diff = job
+    import numpy
+    if diff:
+        x = numpy.diff(x, axis=1)
+        y = numpy.diff(y, axis=1)
+    r, n = correlate(x, y, max_lag)
+    return area, r, n
+
+
+def best_lags(r, max_lag):
+    """Return the lag (0..max_lag) of the strongest correlation of each pair, or -1."""
+    import numpy
+    ahead = numpy.abs(r[..., max_lag:])
+    present = ~numpy.isnan(ahead).all(axis=-1)
+    best = numpy.argmax(numpy.where(numpy.isnan(ahead), -1, ahead), axis=-1)
+    return numpy.where(present, best, -1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Correlate policy and outcome series at lags of days.")
+    parser.add_argument('--policy', type=str, nargs='+', default=[POLICY_PREFIX + "STRINGENCY"],
+                        help='policy metrics')
+    parser.add_argument('--outcome', type=str, nargs='+',
+                        help='outcome metrics (default: every metric not from OxCGRT)')
+    parser.add_argument('--area', type=str, nargs='+', help='areas (default: every area with both)')
+    parser.add_argument('--max-lag', metavar='DAYS', type=int, default=60, help='largest lag')
+    parser.add_argument('--diff', action='store_true', help='correlate day-to-day changes, not levels')
+    parser.add_argument('--all', action='store_true', help='print the correlation at every lag')
+    parser.add_argument('--jobs', type=int, help='correlate areas in N processes')
+    covid.add_profile_argument(parser)
+    parser.add_argument('path', metavar='STORE', type=str, help='store directory')
+
+    args = parser.parse_args()
+    if args.max_lag < 0:
+        parser.error("--max-lag must not be negative")
+    covid.profile(args.profile)
+
+    import numpy
+    import store
+    import concurrent.futures
+    db = store.Store(args.path)
+    outcomes = args.outcome or [m for m in db.metrics if not m.startswith(POLICY_PREFIX)]
+    areas = args.area or db.areas
+
+    with covid.stage("align"):
+        policy = db.get(areas, args.policy).astype(numpy.float64)
+        outcome = db.get(areas, outcomes).astype(numpy.float64)
+        work = []
+        for i, area in enumerate(areas):
+            # skip areas without any policy or outcome series
+            if numpy.isnan(policy[i]).all() or numpy.isnan(outcome[i]).all():
+                continue
+            work.append((area, policy[i], outcome[i], args.max_lag, args.diff))
+
+    lags = range(-args.max_lag, args.max_lag + 1)
+    print("area,policy,outcome,lag,r,days")
+    with covid.stage("correlate", rows=len(work)), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for area, r, n in pool.map(correlate_area, work):
+            covid.count("areas")
+            best = best_lags(r, args.max_lag)
+            for i_policy, p in enumerate(args.policy):
+                for i_outcome, o in enumerate(outcomes):
+                    if args.all:
+                        for i_lag, lag in enumerate(lags):
+                            if r[i_policy, i_outcome, i_lag] == r[i_policy, i_outcome, i_lag]:
+                                print(f"{area},{p},{o},{lag},{r[i_policy, i_outcome, i_lag]:.4f},"
+                                      f"{n[i_policy, i_outcome, i_lag]}")
+                    elif best[i_policy, i_outcome] >= 0:
+                        i_lag = args.max_lag + best[i_policy, i_outcome]
+                        print(f"{area},{p},{o},{best[i_policy, i_outcome]},"
+                              f"{r[i_policy, i_outcome, i_lag]:.4f},{n[i_policy, i_outcome, i_lag]}")
+
+
+if __name__ == "__main__":
+    main()
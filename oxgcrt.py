@@ -10,8 +10,7 @@ import argparse
 import pprint
 import enum
 import csv
-import numpy
-import matplotlib.pyplot as plt
+import datetime
 
 import covid
 
@@ -24,6 +23,8 @@ XTICKS = 8
 FIGSIZE = (15, 4)
 DPI = 200
 
+STORE_PREFIX = "OXCGRT_"
+
 TOTAL_NAT = "NAT_TOTAL"
 TOTAL_STATE = "STATE_TOTAL"
 
@@ -53,83 +54,355 @@ class Metric(enum.Enum):
     STRINGENCY = 59
 
 
-class OxCGRT:
-    data = None
-    arr = None
+# metrics that don't fit an ordinal byte, with their storage type and scale
+# (stringency is kept in hundredths)
+WIDE = {
+    Metric.FISCAL: ("float32", None),
+    Metric.STRINGENCY: ("uint16", 100)
+}
+ORDINAL = [m for m in Metric if m not in WIDE]
 
-    def __read_data(self, fname):
-        """Parse the CSV file."""
-        with open(fname, newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            self.data = list(reader)
 
-    def __normalize_data(self):
-        """Transform data from CSV to numpy array."""
-        self.heading = self.data[0]
-        for i, h in enumerate(self.heading):
-            print(i, h)
-        print()
+class OxCGRT:
 
-        self.data = self.data[1:]
+    def __read_data(self, lines):
+        """Parse CSV lines as they arrive into columns of code and date indices
+        and metric values (NaN if missing)."""
+        from array import array
+        reader = csv.reader(lines, delimiter=',', quotechar='"')
+        self.heading = next(reader)
         self.country_code = {}
         self.code_name = {}
-        self.dates = set()
-        for row in self.data:
+        code_idx = {}
+        date_idx = {}
+        self.rows = 0
+        self.row_code = array('i')
+        self.row_date = array('i')
+        self.row_values = array('d')
+        nan = float("nan")
+        for row in reader:
             self.code_name[row[I_COUNTRY_CODE]] = row[I_COUNTRY_NAME]
             country = self.country_code.setdefault(row[I_COUNTRY_NAME],
                                                    (row[I_COUNTRY_CODE], {}))
             if row[I_JUSRISDICTION] == TOTAL_STATE:
                 country[1][row[I_REGION_NAME]] = row[I_REGION_CODE]
                 self.code_name[row[I_REGION_CODE]] = row[I_REGION_NAME]
-            self.dates.add(row[I_DATE])
-
-        pprint.pprint(self.country_code)
-        print()
+                code = row[I_REGION_CODE]
+            else:
+                code = row[I_COUNTRY_CODE]
+            self.row_code.append(code_idx.setdefault(code, len(code_idx)))
+            self.row_date.append(date_idx.setdefault(row[I_DATE], len(date_idx)))
+            self.row_values.extend([float(row[m.value]) if row[m.value] else nan for m in Metric])
+            self.rows += 1
+        self.codes = list(code_idx)
+        self.dates = list(date_idx)
 
-        if not args.code:
-            sys.exit(-1)
+    def __normalize_data(self):
+        """Transform the columns to numpy arrays: a uint8 cube of the ordinal metrics,
+        one array for each wide metric, and a bitmask of missing values."""
+        import numpy
+        # codes and dates in order of arrival, then sorted
+        code_order = numpy.argsort(self.codes)
+        date_order = numpy.argsort(self.dates)
+        i_code = numpy.argsort(code_order)[numpy.frombuffer(self.row_code, dtype=numpy.int32)]
+        i_date = numpy.argsort(date_order)[numpy.frombuffer(self.row_date, dtype=numpy.int32)]
+        values = numpy.frombuffer(self.row_values, dtype=numpy.float64).reshape(-1, len(Metric))
+        del self.row_code, self.row_date, self.row_values
 
         # name_idx = index(sorted(code_name.values()))
-        self.codes = list(sorted(self.code_name.keys()))
+        self.codes = [self.codes[i] for i in code_order]
         self.code_idx = covid.index(self.codes)
-        self.dates = list(sorted(self.dates))
+        self.dates = [self.dates[i] for i in date_order]
         self.date_idx = covid.index(self.dates)
         self.metric_idx = covid.index([x.name for x in Metric])
+        self.ordinal_idx = covid.index([x.name for x in ORDINAL])
+
+        shape = (len(self.codes), len(self.dates))
+        missing = numpy.ones((shape[0], len(Metric), shape[1]), dtype=bool)
+        missing[i_code, :, i_date] = numpy.isnan(values)
+        values = numpy.nan_to_num(values)
+
+        columns = [self.metric_idx[m.name] for m in ORDINAL]
+        self.ordinal = numpy.zeros((shape[0], len(ORDINAL), shape[1]), dtype=numpy.uint8)
+        self.ordinal[i_code, :, i_date] = values[:, columns]
+        self.wide = {}
+        for metric, (dtype, scale) in WIDE.items():
+            column = values[:, self.metric_idx[metric.name]]
+            if scale:
+                column = numpy.round(column * scale)
+            self.wide[metric.name] = numpy.zeros(shape, dtype=dtype)
+            self.wide[metric.name][i_code, i_date] = column
+
+        self.missing = numpy.packbits(missing, axis=-1)
+
+    def nbytes(self):
+        """Return the size of the arrays."""
+        return self.ordinal.nbytes + self.missing.nbytes + sum(x.nbytes for x in self.wide.values())
+
+    def __values(self, metric, i_code=slice(None)):
+        """Return the float32 values of a metric, missing values unmasked."""
+        import numpy
+        if metric in self.wide:
+            values = self.wide[metric][i_code].astype(numpy.float32)
+            scale = WIDE[Metric[metric]][1]
+            return values / scale if scale else values
+        return self.ordinal[i_code, self.ordinal_idx[metric]].astype(numpy.float32)
+
+    def __missing(self, metric, i_code=slice(None)):
+        import numpy
+        return numpy.unpackbits(self.missing[i_code, self.metric_idx[metric]], axis=-1,
+                                count=len(self.dates)).astype(bool)
+
+    def series(self, metric):
+        """Return a masked (codes x dates) array of a metric."""
+        import numpy
+        return numpy.ma.MaskedArray(self.__values(metric), self.__missing(metric))
+
+    def cube(self):
+        """Return the masked (codes x metrics x dates) float32 array of every metric."""
+        import numpy
+        return numpy.ma.stack([self.series(m.name) for m in Metric], axis=1)
+
+    def describe(self):
+        """Print the CSV columns and the country and region codes."""
+        for i, h in enumerate(self.heading):
+            print(i, h)
+        print()
+        pprint.pprint(self.country_code)
+        print()
 
-        self.arr = numpy.zeros((len(self.code_idx), len(Metric), len(self.date_idx)),
-                               dtype=numpy.float32)
-
-        for row in self.data:
-            for metric in Metric:
-                val = row[metric.value]
-                if not val:
-                    continue
-                i_code = self.code_idx[row[I_COUNTRY_CODE]]
-                i_metric = self.metric_idx[metric.name]
-                i_date = self.date_idx[row[I_DATE]]
-                self.arr[i_code, i_metric, i_date] = val
+    def date(self, i_date):
+        """Return the date at a date index."""
+        return datetime.datetime.strptime(self.dates[i_date], "%Y%m%d").date()
+
+    def intervals(self, metric, threshold):
+        """Return (code, start, end) for each run of days with metric >= threshold.
+        The end is the first day below threshold, or None if the run is ongoing."""
+        import numpy
+        above = (self.series(metric) >= threshold).filled(False)
+        edges = numpy.diff(numpy.pad(above.astype(numpy.int8), ((0, 0), (1, 1))), axis=1)
+        # rising and falling edges pair up in row-major order
+        i_code, i_start = numpy.nonzero(edges == 1)
+        _, i_end = numpy.nonzero(edges == -1)
+        ndates = len(self.dates)
+        return [(self.codes[c], self.date(s), self.date(e) if e < ndates else None)
+                for c, s, e in zip(i_code.tolist(), i_start.tolist(), i_end.tolist())]
 
     def get(self, code, metric):
+        """Return the masked daily series of a metric; missing days are masked."""
+        import numpy
         i_code = self.code_idx[code]
-        try:
-            i_metric = self.metric_idx[metric]
-        except KeyError:
+        if metric not in self.metric_idx:
             print("Metrics:")
             for metric in sorted(self.metric_idx):
                 print(metric)
             sys.exit(-1)
-        return self.arr[i_code, i_metric]
+        return numpy.ma.MaskedArray(self.__values(metric, i_code), self.__missing(metric, i_code))
+
+    def nations(self):
+        """Return the national codes."""
+        return sorted(code for code, _ in self.country_code.values())
+
+    def __rows(self, codes):
+        return [self.code_idx[code] for code in (self.nations() if codes is None else codes)]
+
+    def aggregate(self, metric, how="mean", codes=None, groups=None, weights=None):
+        """Reduce a metric over codes (the national codes by default) for each day.
+        groups maps codes to group names and weights maps codes to weights for the mean;
+        codes missing from either are left out. Return {group: masked daily series},
+        with a single group "ALL" if groups is None."""
+        import numpy
+        codes = self.nations() if codes is None else codes
+        if groups is None:
+            groups = {code: "ALL" for code in codes}
+        members = {}
+        for code in codes:
+            if code in groups and (weights is None or code in weights):
+                members.setdefault(groups[code], []).append(code)
+        series = self.series(metric)
+        rv = {}
+        for group, group_codes in sorted(members.items()):
+            values = series[self.__rows(group_codes)]
+            if how == "mean":
+                w = None if weights is None else numpy.array([weights[c] for c in group_codes])
+                rv[group] = numpy.ma.average(values, axis=0, weights=w)
+            elif how == "median":
+                rv[group] = numpy.ma.median(values, axis=0)
+            else:
+                rv[group] = getattr(values, how)(axis=0)
+        return rv
+
+    @staticmethod
+    def ranked(codes, values, top=None):
+        """Return [(code, value)] in descending order of the masked values, skipping masked."""
+        import numpy
+        values = numpy.ma.asarray(values)
+        present = numpy.flatnonzero(~numpy.ma.getmaskarray(values))
+        order = present[numpy.argsort(-values.data[present], kind="stable")][:top]
+        return [(codes[i], values.data[i].item()) for i in order]
+
+    def rank(self, metric, i_date=None, top=None, codes=None):
+        """Return the top codes (national by default) by metric on a date index,
+        by default the latest date with any value."""
+        import numpy
+        codes = self.nations() if codes is None else codes
+        values = self.series(metric)[self.__rows(codes)]
+        if i_date is None:
+            present = numpy.flatnonzero((~numpy.ma.getmaskarray(values)).any(axis=0))
+            i_date = present[-1] if len(present) else -1
+        return self.ranked(codes, values[:, i_date], top)
+
+    def days_above(self, metric, threshold, top=None, codes=None):
+        """Return the top codes (national by default) by number of days with metric >= threshold."""
+        codes = self.nations() if codes is None else codes
+        above = (self.series(metric)[self.__rows(codes)] >= threshold).filled(False)
+        return self.ranked(codes, above.sum(axis=1), top)
+
+    def __init__(self, fname=None, lines=None):
+        """Read the CSV file fname, or an iterable of its lines."""
+        with covid.stage("oxcgrt read") as record:
+            if lines is None:
+                with open(fname, newline='') as csvfile:
+                    self.__read_data(csvfile)
+            else:
+                self.__read_data(lines)
+            record["rows"] = self.rows
+        with covid.stage("oxcgrt normalize", rows=self.rows) as record:
+            self.__normalize_data()
+            record["bytes"] = self.nbytes()
+
+    @classmethod
+    def fetch(cls, url=URL, dest=DATA_FILE, shelf_life=60*60*24):
+        """Download dest from url (unless it is fresh) and parse it at the same time."""
+        return cls(lines=covid.lines(covid.stream(url, dest, shelf_life)))
+
+
+class Remote:
+    """OxCGRT series answered by the resident data service."""
+
+    def __init__(self, response):
+        self.dates = response["dates"]
+        self.code_name = response["names"]
+        self.series = response["series"]
+
+    @classmethod
+    def query(cls, codes, metrics):
+        """Return the series from the service, or None if it isn't running."""
+        response = covid.query("/oxcgrt", code=codes, metric=metrics)
+        if response is None:
+            return None
+        print("using service at", covid.SERVICE)
+        return cls(response)
 
-    def __init__(self, fname):
-        self.__read_data(fname)
-        self.__normalize_data()
+    def get(self, code, metric):
+        import numpy
+        return numpy.ma.masked_invalid(numpy.array(self.series[metric][code], dtype=numpy.float32))
+
+
+class Aggregate:
+    """Aggregate series of each group, plotted like codes."""
+
+    def __init__(self, oxgcrt, args):
+        weights = read_table(args.weights, float) if args.weights else None
+        groups = read_table(args.groups) if args.groups else None
+        self.dates = oxgcrt.dates
+        self.series = {}
+        for metric in args.metric:
+            self.series[metric.upper()] = oxgcrt.aggregate(metric.upper(), args.aggregate,
+                                                           groups=groups, weights=weights)
+        self.groups = sorted(set(g for x in self.series.values() for g in x))
+        self.code_name = {g: f"{g} ({args.aggregate})" for g in self.groups}
+
+    def get(self, group, metric):
+        import numpy
+        return self.series[metric].get(group, numpy.ma.masked_all(len(self.dates)))
+
+
+def read_table(fname, convert=str):
+    """Read a two-column CSV file of codes and values (a header row is skipped)."""
+    with open(fname, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    table = {}
+    for i, row in enumerate(rows):
+        try:
+            table[row[0]] = convert(row[1])
+        except ValueError:
+            if i:
+                raise
+    return table
 
 
-def oxgcrt(args):
-    covid.download(URL, DATA_FILE, shelf_life=60*60*24)
+def print_ranked(oxgcrt, ranked):
+    print("code,name,value")
+    for code, value in ranked:
+        print(f"{code},{oxgcrt.code_name[code]},{value:g}")
 
-    oxgcrt = OxCGRT(DATA_FILE)
 
+def oxgcrt(args):
+    summary = args.rank or args.days_above is not None or args.aggregate
+    if not args.no_service and not args.store and not summary:
+        remote = Remote.query(args.code, [m.upper() for m in args.metric])
+        if remote is not None:
+            with covid.stage("plot"):
+                plot(remote, args)
+            return
+
+    # the download and the parse overlap
+    oxgcrt = OxCGRT.fetch()
+    if not summary:
+        oxgcrt.describe()
+
+    if args.store:
+        import numpy
+        import store
+        with covid.stage("store"):
+            store.Store(args.store).put(
+                oxgcrt.codes, [STORE_PREFIX + m.name for m in Metric],
+                [oxgcrt.date(i) for i in range(len(oxgcrt.dates))], oxgcrt.cube().filled(numpy.nan))
+
+    metric = args.metric[0].upper()
+    if args.rank:
+        i_date = None
+        if args.rank != "latest":
+            try:
+                i_date = oxgcrt.date_idx.get(datetime.date.fromisoformat(args.rank).strftime("%Y%m%d"))
+            except ValueError:
+                pass
+            if i_date is None:
+                sys.exit(f"--rank {args.rank}: expected latest or a date from "
+                         f"{oxgcrt.date(0)} to {oxgcrt.date(len(oxgcrt.dates) - 1)}")
+        with covid.stage("rank"):
+            ranked = oxgcrt.rank(metric, i_date, args.top)
+        print_ranked(oxgcrt, ranked)
+        return
+    if args.days_above is not None:
+        with covid.stage("days above"):
+            ranked = oxgcrt.days_above(metric, args.days_above, args.top)
+        print_ranked(oxgcrt, ranked)
+        return
+    if args.aggregate:
+        with covid.stage("aggregate"):
+            aggregate = Aggregate(oxgcrt, args)
+        with covid.stage("plot"):
+            plot(aggregate, args, aggregate.groups)
+        return
+
+    if args.code:
+        with covid.stage("plot"):
+            plot(oxgcrt, args)
+
+
+def plot(oxgcrt, args, codes=None):
+    import numpy
+    codes = codes or args.code
+    metrics = [m.upper() for m in args.metric]
+    if args.png:
+        key = covid.render_key(plot, oxgcrt.dates, codes, metrics,
+                               [oxgcrt.code_name[c] for c in codes],
+                               [oxgcrt.get(c, m) for m in metrics for c in codes])
+        if covid.rendered(args.png, key):
+            return
+    plt = covid.pyplot(interactive=not args.png)
     figsize = (FIGSIZE[0], FIGSIZE[1] * len(args.metric))
     fig = plt.figure("OxCGRT", figsize=figsize)
     fig.subplots_adjust(left=0.05, right=0.98)
@@ -138,24 +411,47 @@ def oxgcrt(args):
         ax = fig.add_subplot(len(args.metric), 1, i_metric + 1,
                              xmargin=0)
         ax.set_ylabel("OxCGRT "+metric.capitalize())
-        for code in args.code:
+        buckets = covid.axis_pixels(ax, DPI if args.png else None)
+        for code in codes:
             row = oxgcrt.get(code, metric)
             label = oxgcrt.code_name[code]
-            ax.plot(range(len(oxgcrt.dates)), row, label=label)
+            ax.plot(*covid.downsample(numpy.arange(len(row)), row, buckets), label=label)
         covid.add_ticks(plt, XTICKS, range(len(oxgcrt.dates)), oxgcrt.dates)
-        if len(args.code) > 1:
+        if len(codes) > 1:
             handles, labels = ax.get_legend_handles_labels()
             ax.legend(handles, labels)
-    plt.show()
+    if args.png:
+        covid.savefig(plt, args.png, key, dpi=DPI)
+    else:
+        plt.show()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Plot country policy data.")
     parser.add_argument('--metric', nargs='+', type=str, default=['STRINGENCY'], help='Metric to use')
     parser.add_argument('--png', type=str, help='store to PNG')
-    parser.add_argument('code', type=str, nargs='+',
+    parser.add_argument('--store', metavar='DIR', type=str, help='write all series to the shared store')
+    parser.add_argument('--no-service', action='store_true', help="don't query the resident data service")
+    parser.add_argument('--aggregate', choices=["mean", "median", "min", "max"],
+                        help='plot the metric reduced over the national codes')
+    parser.add_argument('--groups', metavar='CSV', type=str,
+                        help='aggregate each group of a code,group file (e.g. continents)')
+    parser.add_argument('--weights', metavar='CSV', type=str,
+                        help='weight the mean by a code,weight file (e.g. population)')
+    parser.add_argument('--rank', metavar='DATE', type=str,
+                        help='print the national codes ranked by the metric on DATE (or "latest")')
+    parser.add_argument('--days-above', metavar='T', type=float,
+                        help='print the national codes ranked by days with the metric >= T')
+    parser.add_argument('--top', metavar='N', type=int, help='print only the top N codes')
+    covid.add_profile_argument(parser)
+    parser.add_argument('code', type=str, nargs='*',
                         help='Country or region codes to plot')
 
     args = parser.parse_args()
+    if not args.code and not (args.rank or args.days_above is not None or args.aggregate or args.store):
+        parser.error("no codes to plot")
+    if args.weights and args.aggregate != "mean":
+        parser.error("--weights requires --aggregate mean")
+    covid.profile(args.profile)
 
     oxgcrt(args)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Resident data service: load the VAERS and OxCGRT data once and answer
+queries over HTTP on localhost with JSON, so that the scripts don't have to
+re-read the CSV files on every run. vaers.py and oxgcrt.py use it when it
+is running (see covid.query).
+
+  GET /status
+  GET /onset?death=0|1
+  GET /vaxfreq?vax=COVID19&symptoms=headache
+  GET /oxcgrt?code=GBR&code=USA&metric=STRINGENCY
+"""
+
+import os
+import sys
+import json
+import argparse
+import urllib.parse
+import concurrent.futures
+
+import covid
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "vaers"))
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Service:
+    vaers = None
+    policy = None
+
+    def __init__(self, vax_files, oxcgrt):
+        self.vax_files = sorted(os.path.abspath(x) for x in vax_files if x.endswith('VAERSVAX.csv'))
+        self.results = {}
+        # one query at a time, off the event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if self.vax_files:
+            import vaers
+            with covid.stage("load vaers"):
+                self.vaers = vaers.load(self.vax_files)
+        if oxcgrt:
+            import oxgcrt
+            with covid.stage("load oxcgrt"):
+                self.policy = oxgcrt.OxCGRT.fetch()
+
+    def status(self, params):
+        return {"vaers": self.vax_files, "oxcgrt": self.policy is not None}
+
+    def tabulate(self, **kwargs):
+        """Return vaers.tabulate for these arguments, computing it once."""
+        import vaers
+        if self.vaers is None:
+            raise BadRequest("no VAERS files loaded")
+        key = json.dumps(kwargs, sort_keys=True)
+        if key not in self.results:
+            args = argparse.Namespace(death=False, vaxfreq=None, symptoms=None)
+            for k, v in kwargs.items():
+                setattr(args, k, v)
+            self.results[key] = vaers.tabulate(self.vaers, args)
+        return self.results[key]
+
+    def onset(self, params):
+        death = params.get("death", ["0"])[0] not in ("0", "")
+        return self.tabulate(death=death)
+
+    def vaxfreq(self, params):
+        return self.tabulate(vaxfreq=params.get("vax", ["ALL"]),
+                             symptoms=params.get("symptoms"))
+
+    def oxcgrt(self, params):
+        if self.policy is None:
+            raise BadRequest("OxCGRT data not loaded")
+        codes = params.get("code", [])
+        metrics = [m.upper() for m in params.get("metric", ["STRINGENCY"])]
+        for code in codes:
+            if code not in self.policy.code_idx:
+                raise BadRequest(f"unknown code {code}")
+        for metric in metrics:
+            if metric not in self.policy.metric_idx:
+                raise BadRequest(f"unknown metric {metric}")
+        series = {}
+        for metric in metrics:
+            series[metric] = {}
+            for code in codes:
+                row = self.policy.get(code, metric)
+                series[metric][code] = [None if v != v else v for v in row.tolist()]
+        return {
+            "dates": self.policy.dates,
+            "names": {code: self.policy.code_name[code] for code in codes},
+            "series": series
+        }
+
+    async def handle(self, reader, writer):
+        """Answer one HTTP request."""
+        import asyncio
+        routes = {
+            "/status": self.status,
+            "/onset": self.onset,
+            "/vaxfreq": self.vaxfreq,
+            "/oxcgrt": self.oxcgrt
+        }
+        try:
+            request = (await reader.readline()).decode("latin1").split()
+            # skip the headers
+            while (await reader.readline()).strip():
+                pass
+            if len(request) < 2 or request[0] != "GET":
+                raise BadRequest("only GET is supported")
+            url = urllib.parse.urlsplit(request[1])
+            route = routes.get(url.path)
+            if route is None:
+                status, body = "404 Not Found", {"error": url.path}
+            else:
+                params = urllib.parse.parse_qs(url.query)
+                loop = asyncio.get_running_loop()
+                status, body = "200 OK", await loop.run_in_executor(self.executor, route, params)
+                covid.count("queries")
+        except BadRequest as e:
+            status, body = "400 Bad Request", {"error": str(e)}
+        except Exception as e:
+            status, body = "500 Internal Server Error", {"error": repr(e)}
+        data = json.dumps(body).encode()
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+        await writer.drain()
+        writer.close()
+
+
+async def serve(service, host, port):
+    import asyncio
+    server = await asyncio.start_server(service.handle, host, port)
+    print("serving on", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve VAERS and OxCGRT queries from memory.")
+    parser.add_argument('--oxcgrt', action='store_true', help='load the OxCGRT data')
+    parser.add_argument('--bind', type=str, default=covid.SERVICE, help='host:port to listen on')
+    covid.add_profile_argument(parser)
+    parser.add_argument('vaers', metavar='VAERSVAX.csv', type=str, nargs='*',
+                        help='VAERS files from https://vaers.hhs.gov/data/datasets.html')
+
+    args = parser.parse_args()
+    covid.profile(args.profile)
+
+    service = Service(args.vaers, args.oxcgrt)
+    host, port = args.bind.rsplit(":", 1)
+    import asyncio
+    try:
+        asyncio.run(serve(service, host, int(port)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
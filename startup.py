@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Measure the startup time of each entry point against its budget.
+Each script is run with --help, which should not import numpy, pandas or matplotlib.
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+
+# seconds for "SCRIPT --help", median of several runs
+BUDGETS = {
+    "causes.py": 0.15,
+    "estimated_inpatient_covid.py": 0.15,
+    "lag.py": 0.15,
+    "oxgcrt.py": 0.15,
+    "service.py": 0.15,
+    "uk_data.py": 0.15,
+    "vaers/vaers.py": 0.15,
+}
+
+HEAVY = ["numpy", "pandas", "matplotlib", "dateutil"]
+
+
+def measure(script, runs):
+    """Return the median wall time of running the script with --help."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, path, "--help"], check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def heavy_imports(script):
+    """Return the heavy modules imported by running the script with --help."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    proc = subprocess.run([sys.executable, "-X", "importtime", path, "--help"], check=True,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported = {line.split("|")[-1].strip() for line in proc.stderr.splitlines()}
+    return [m for m in HEAVY if m in imported]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check entry point startup times.")
+    parser.add_argument('--runs', type=int, default=5, help='runs per script')
+    parser.add_argument('scripts', type=str, nargs='*', default=list(BUDGETS),
+                        help='scripts to measure')
+
+    args = parser.parse_args()
+
+    over = 0
+    for script in args.scripts:
+        elapsed = measure(script, args.runs)
+        budget = BUDGETS.get(script)
+        heavy = heavy_imports(script)
+        status = "ok"
+        if heavy or (budget is not None and elapsed > budget):
+            status = "OVER"
+            over += 1
+        print(f"{script:32s} {elapsed:0.3f}s / {budget}s {status:4s} {' '.join(heavy)}")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
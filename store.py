@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Shared on-disk store of daily series from every data source.
+Values are kept in one memory-mapped float32 array (area x metric x day)
+on a common daily calendar, with area and metric names in index.json.
+Missing values are NaN.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import contextlib
+import datetime
+import argparse
+
+import covid
+
+
+CALENDAR_START = datetime.date(2020, 1, 1)
+INDEX_FILE = "index.json"
+DATA_FILE = "data.f32"
+LOCK_FILE = "store.lock"
+
+
+class Store:
+    """Writers hold an exclusive lock on the store while they merge into it, and
+    readers a shared one. The index names the data file, and a resize writes a new
+    data file before the index is replaced, so the index always matches its data."""
+    arr = None
+    data_file = None
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        with self.__lock(fcntl.LOCK_SH):
+            self.__load()
+
+    def __file(self, fname):
+        return os.path.join(self.path, fname)
+
+    @contextlib.contextmanager
+    def __lock(self, mode):
+        try:
+            fd = open(self.__file(LOCK_FILE), "a")
+        except PermissionError:
+            # a reader without write access only needs the file open for a shared lock
+            fd = open(self.__file(LOCK_FILE))
+        with fd:
+            fcntl.flock(fd, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def __load(self, mode="r"):
+        """Read the index and map its data file; call with the lock held."""
+        index = {"start": CALENDAR_START.isoformat(), "days": 0, "areas": [], "metrics": []}
+        if os.path.exists(self.__file(INDEX_FILE)):
+            with open(self.__file(INDEX_FILE)) as fd:
+                index = json.load(fd)
+        self.start = datetime.date.fromisoformat(index["start"])
+        self.days = index["days"]
+        self.areas = index["areas"]
+        self.metrics = index["metrics"]
+        self.area_idx = covid.index(self.areas)
+        self.metric_idx = covid.index(self.metrics)
+        self.data_file = index.get("data", DATA_FILE)
+        self.arr = None
+        if self.days:
+            self.arr = self.__open(self.data_file, mode, self.shape())
+
+    def __open(self, fname, mode, shape):
+        import numpy
+        return numpy.memmap(self.__file(fname), dtype=numpy.float32, mode=mode, shape=shape)
+
+    def __write_index(self):
+        index = {"start": self.start.isoformat(), "days": self.days,
+                 "areas": self.areas, "metrics": self.metrics, "data": self.data_file}
+        with open(self.__file(INDEX_FILE + ".tmp"), "w") as fd:
+            json.dump(index, fd, indent=1)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(self.__file(INDEX_FILE + ".tmp"), self.__file(INDEX_FILE))
+
+    def __resize(self, shape):
+        """Copy the array to a new data file of the given shape, keeping the existing
+        values; the new file is used once the index naming it is written."""
+        import numpy
+        fname = "data.{0:d}x{1:d}x{2:d}.f32".format(*shape)
+        arr = self.__open(fname, "w+", shape)
+        arr[:] = numpy.nan
+        if self.arr is not None:
+            old = self.arr.shape
+            arr[:old[0], :old[1], :old[2]] = self.arr
+        arr.flush()
+        return fname, arr
+
+    def shape(self):
+        return (len(self.areas), len(self.metrics), self.days)
+
+    def day(self, date):
+        """Return the calendar offset of a date."""
+        return (date - self.start).days
+
+    def dates(self):
+        """Return the calendar."""
+        return [self.start + datetime.timedelta(days=i) for i in range(self.days)]
+
+    def put(self, areas, metrics, dates, values):
+        """Write an (areas x metrics x dates) array of values; NaN marks missing values.
+        The index is re-read under the lock, so concurrent writers keep each other's series."""
+        import numpy
+        days = numpy.array([self.day(d) for d in dates], dtype=numpy.int64)
+        if len(days) and days.min() < 0:
+            raise ValueError(f"dates before {self.start} are not supported")
+        with self.__lock(fcntl.LOCK_EX):
+            self.__load("r+")
+            for area in areas:
+                if area not in self.area_idx:
+                    self.area_idx[area] = len(self.areas)
+                    self.areas.append(area)
+            for metric in metrics:
+                if metric not in self.metric_idx:
+                    self.metric_idx[metric] = len(self.metrics)
+                    self.metrics.append(metric)
+            if len(days):
+                self.days = max(self.days, int(days.max()) + 1)
+            old_file = None
+            if self.arr is None or self.arr.shape != self.shape():
+                old_file = self.data_file if self.arr is not None else None
+                self.data_file, self.arr = self.__resize(self.shape())
+            i_area = [self.area_idx[a] for a in areas]
+            i_metric = [self.metric_idx[m] for m in metrics]
+            self.arr[numpy.ix_(i_area, i_metric, days)] = values
+            self.arr.flush()
+            # the index is the commit point: until it is replaced, readers see the old file
+            self.__write_index()
+            if old_file is not None:
+                os.remove(self.__file(old_file))
+
+    def get(self, areas, metrics, date_first=None, date_last=None):
+        """Return an (areas x metrics x days) array aligned on the calendar,
+        from date_first to date_last inclusive. Unknown areas and metrics are NaN."""
+        import numpy
+        # pick up series written since the store was opened, and copy them
+        # before a writer can change them
+        with self.__lock(fcntl.LOCK_SH):
+            self.__load()
+            first = 0 if date_first is None else self.day(date_first)
+            last = self.days - 1 if date_last is None else self.day(date_last)
+            rv = numpy.full((len(areas), len(metrics), last - first + 1), numpy.nan,
+                            dtype=numpy.float32)
+            if self.arr is None:
+                return rv
+            rows = [(i, self.area_idx[a]) for i, a in enumerate(areas) if a in self.area_idx]
+            cols = [(i, self.metric_idx[m]) for i, m in enumerate(metrics) if m in self.metric_idx]
+            lo, hi = max(first, 0), min(last + 1, self.days)
+            if rows and cols and lo < hi:
+                r_out, r_in = zip(*rows)
+                c_out, c_in = zip(*cols)
+                rv[numpy.ix_(r_out, c_out, range(lo - first, hi - first))] = \
+                    self.arr[numpy.ix_(r_in, c_in, range(lo, hi))]
+        return rv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print series from the shared store.")
+    parser.add_argument('--area', type=str, nargs='+', help='areas to print')
+    parser.add_argument('--metric', type=str, nargs='+', help='metrics to print')
+    parser.add_argument('path', metavar='STORE', type=str, help='store directory')
+
+    args = parser.parse_args()
+
+    store = Store(args.path)
+    if not args.area or not args.metric:
+        print("Calendar:", store.start, "+", store.days, "days")
+        print("Areas:", " ".join(store.areas))
+        print("Metrics:", " ".join(store.metrics))
+        sys.exit(0)
+
+    arr = store.get(args.area, args.metric)
+    print(",".join(["date"] + [f"{a}:{m}" for a in args.area for m in args.metric]))
+    for i, date in enumerate(store.dates()):
+        row = arr[:, :, i].ravel()
+        print(",".join([date.isoformat()] + ["" if v != v else f"{v:g}" for v in row]))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,18 @@ https://coronavirus.data.gov.uk/details/deaths
 Or use the uk_data.json file included here
 """
 
+from __future__ import annotations
+
+import os
 import json
-import dateutil
+import typing
+import datetime
 import argparse
-import numpy
-import matplotlib.pyplot as plt
+
+import covid
+
+if typing.TYPE_CHECKING:
+    import numpy
 
 ALL = "United Kingdom"
 ENGLAND = "England"
@@ -26,33 +33,19 @@ POPULATIONS = {
 }
 POPULATIONS[ALL] = sum(POPULATIONS.values())
 
-LOCKDOWNS = {
-    ENGLAND: [
-        [dateutil.parser.parse('March 23 2020'),
-         dateutil.parser.parse('July 4 2020')],
-        [dateutil.parser.parse('November 5 2020'),
-         dateutil.parser.parse('December 3 2020')],
-        [dateutil.parser.parse('January 4 2021'),
-         dateutil.parser.parse('April 12 2021')]
-     ],
-    N_IRELAND: [
-        [dateutil.parser.parse('October 16 2020'),
-         dateutil.parser.parse('November 20 2020')],
-        [dateutil.parser.parse('November 27 2020'),
-         None]
-     ],
-    SCOTLAND: [
-        [dateutil.parser.parse('October 23 2020'),
-         dateutil.parser.parse('November 9 2020')],
-        [dateutil.parser.parse('November 20 2020'),
-         None]
-     ],
-    WALES: [
-        [dateutil.parser.parse('October 23 2020'),
-         dateutil.parser.parse('November 9 2020')],
-     ]
+# OxCGRT codes for each nation, for deriving lockdowns from stringency
+OXCGRT_CODES = {
+    ALL: "GBR",
+    ENGLAND: "UK_ENG",
+    N_IRELAND: "UK_NIR",
+    SCOTLAND: "UK_SCO",
+    WALES: "UK_WAL"
 }
 
+STORE_METRIC = "UK_DEATHS"
+
+LOCKDOWNS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lockdowns.csv")
+
 XTICKS = 16
 FIGSIZE = (14, 14)
 DPI = 200
@@ -62,7 +55,7 @@ def read_data(table: list):
     data = {}
     for i, row in enumerate(table):
         nation = row['areaName']
-        date = dateutil.parser.parse(row['date'])
+        date = datetime.datetime.fromisoformat(row['date'])
         data_new = row['newDeaths28DaysByDeathDate']
         if data_new is None:
             continue
@@ -72,26 +65,32 @@ def read_data(table: list):
 
 
 def normalize_data(data: dict):
+    import numpy
     print(data)
     days = list(sorted(data.keys()))
     day_first = days[0]
     days_total = (days[-1] - day_first).days + 1
     series = numpy.array([(d - day_first).days for d in days], dtype=numpy.int32)
     arr = numpy.zeros(shape=(5, days_total), dtype=numpy.int32)
+    # days each nation reported; the others stay 0 in arr
+    filled = numpy.zeros(shape=(5, days_total), dtype=bool)
     nations = {}
     for i, day in enumerate(days):
         si = series[i]
         for nation, nation_data in data[day].items():
             nation_i = nations.setdefault(nation, len(nations))
             arr[nation_i][si] = nation_data
+            filled[nation_i][si] = True
     # Add a nation entry for the UK
     nation_i = nations.setdefault(ALL, len(nations))
     # Put the sum in the last row
     arr[nation_i] = arr[:nation_i].sum(axis=0)
-    return days, nations, series, arr
+    filled[nation_i] = filled[:nation_i].all(axis=0)
+    return days, nations, series, arr, filled
 
 
 def percent_change_on_previous_day(series: numpy.array, data: numpy.array):
+    import numpy
     day = data[:, 1:]
     previous = data[:, :-1]
     change = day - previous
@@ -101,12 +100,14 @@ def percent_change_on_previous_day(series: numpy.array, data: numpy.array):
 
 
 def derivatives(series: numpy.array, data: numpy.array):
+    import numpy
     dData = data[:, 1:] - data[:, :-1]
     dSeries = series[1:] - series[:-1]
     return series[:-1], numpy.true_divide(dData, dSeries)
 
 
 def smooth(w: int, data: numpy.array):
+    import numpy
     rv = numpy.zeros_like(data, dtype=numpy.float32)
     cf = numpy.ones(w)
     for i in range(data.shape[0]):
@@ -114,12 +115,52 @@ def smooth(w: int, data: numpy.array):
     return rv
 
 
-def plot_lockdowns(nation, ax, date_start):
-    for ld_start, ld_end in LOCKDOWNS.get(nation, [[None, None]]):
-        if ld_start is not None:
-            ax.axvline(x=(ld_start - date_start).days, c='r', linewidth=1)
-        if ld_end is not None:
-            ax.axvline(x=(ld_end - date_start).days, c='g', linewidth=1)
+def read_lockdowns(args):
+    """Return an EventIndex of lockdowns, keyed by nation."""
+    if args.stringency is None:
+        return covid.read_events(args.lockdowns)
+    import oxgcrt
+    policy = oxgcrt.OxCGRT.fetch()
+    nations = {code: nation for nation, code in OXCGRT_CODES.items()}
+    return covid.EventIndex(
+        (nations[code], start, end)
+        for code, start, end in policy.intervals(oxgcrt.Metric.STRINGENCY.name, args.stringency)
+        if code in nations)
+
+
+def store_data(path, days: list, nations: dict, data: numpy.array, filled: numpy.array):
+    """Write the daily deaths to the shared store, keyed by OxCGRT code.
+    Days a nation didn't report are stored as missing, and for the UK any day
+    one of the nations didn't report."""
+    import numpy
+    import store
+    rows = sorted(nations.values())
+    areas = [OXCGRT_CODES[n] for n, i in sorted(nations.items(), key=lambda kv: kv[1])]
+    dates = [days[0].date() + datetime.timedelta(days=i) for i in range(data.shape[1])]
+    values = numpy.where(filled[rows], data[rows], numpy.nan)
+    store.Store(path).put(areas, [STORE_METRIC], dates, values[:, None, :])
+
+
+def lockdown_lines(lockdowns, date_first, date_last):
+    """Return {nation: (starts, ends)} of the lockdowns overlapping the dates, in days
+    after date_first, from one lookup for every nation. Open ends are left out."""
+    area, start, end = lockdowns.window(date_first, date_last)
+    lines = {}
+    for a, s, e in zip(area.tolist(), start.tolist(), end.tolist()):
+        starts, ends = lines.setdefault(lockdowns.areas[a], ([], []))
+        starts.append(s)
+        if e >= 0:
+            ends.append(e)
+    return lines
+
+
+def plot_lockdowns(lines, nation, ax):
+    starts, ends = lines.get(nation, ([], []))
+    transform = ax.get_xaxis_transform()
+    if starts:
+        ax.vlines(starts, 0, 1, transform=transform, colors='r', linewidth=1)
+    if ends:
+        ax.vlines(ends, 0, 1, transform=transform, colors='g', linewidth=1)
 
 
 def add_ticks(fig, nticks: int, series: list, dates: list):
@@ -131,17 +172,31 @@ def add_ticks(fig, nticks: int, series: list, dates: list):
     fig.xticks(locs, labels)
 
 
-def plot_data(days: list, nations: dict, series: numpy.array, data: numpy.array, args):
+def plot_data(days: list, nations: dict, series: numpy.array, data: numpy.array, lockdowns, args):
+    plt = covid.pyplot(args.interactive)
+
     if args.smooth > 1:
-        data = smooth(args.smooth, data)
+        with covid.stage("smooth"):
+            data = smooth(args.smooth, data)
 
-    if args.pcopd:
-        d_series, d_nations = percent_change_on_previous_day(series, data)
-    else:
-        d_series, d_nations = derivatives(series, data)
+    with covid.stage("derivatives"):
+        if args.pcopd:
+            d_series, d_nations = percent_change_on_previous_day(series, data)
+        else:
+            d_series, d_nations = derivatives(series, data)
+
+    lines = lockdown_lines(lockdowns, days[0].date(), days[-1].date())
 
     # for each nation...
     for nation, nation_i in sorted(nations.items()):
+        fname = "{0:s}.png".format(nation)
+        if not args.interactive:
+            key = covid.render_key(plot_data, nation, days, series, data[nation_i], d_series,
+                                   d_nations[nation_i], lines.get(nation),
+                                   args.smooth, args.pcopd)
+            if covid.rendered(fname, key):
+                continue
+
         # plot the national deaths
         fig = plt.figure(nation, figsize=FIGSIZE)
         fig.suptitle(nation, fontsize=16, y=0.95)
@@ -158,7 +213,7 @@ def plot_data(days: list, nations: dict, series: numpy.array, data: numpy.array,
         ax1.bar(
             series, data[nation_i],
             width=1)
-        plot_lockdowns(nation, ax1, days[0])
+        plot_lockdowns(lines, nation, ax1)
         if not args.interactive:
             add_ticks(plt, XTICKS, series, days)
 
@@ -168,14 +223,16 @@ def plot_data(days: list, nations: dict, series: numpy.array, data: numpy.array,
             ax2.set_ylabel('% change on previous day')
         else:
             ax2.set_ylabel('dDeath/dTime')
-        ax2.plot(d_series, d_nations[nation_i])
+        buckets = covid.axis_pixels(ax2, None if args.interactive else DPI)
+        ax2.plot(*covid.downsample(d_series, d_nations[nation_i], buckets))
         ax2.axhline(y=0, linewidth=1, c='b')
-        plot_lockdowns(nation, ax2, days[0])
+        plot_lockdowns(lines, nation, ax2)
         if not args.interactive:
             add_ticks(plt, XTICKS, series, days)
 
         if not args.interactive:
-            plt.savefig("{0:s}.png".format(nation), dpi=DPI)
+            covid.savefig(plt, fname, key, dpi=DPI)
+            plt.close(fig)
 
     if args.interactive:
         plt.show()
@@ -186,21 +243,36 @@ def main():
     parser.add_argument('--smooth', metavar='W', type=int, default=1,
                         help='smooth the dataset')
     parser.add_argument('--interactive', action='store_true', help='display charts interactively')
-    parser.add_argument('--pcopd', action='store_true', help='compute "% change on previous day" rather than derivative')
+    parser.add_argument('--pcopd', action='store_true', help='compute "%% change on previous day" rather than derivative')
+    parser.add_argument('--lockdowns', metavar='LOCKDOWNS.csv', type=str, default=LOCKDOWNS_FILE,
+                        help='CSV file of area,start,end lockdown dates')
+    parser.add_argument('--stringency', metavar='T', type=float,
+                        help='derive lockdowns from OxCGRT stringency >= T instead')
+    parser.add_argument('--store', metavar='DIR', type=str, help='write the series to the shared store')
+    covid.add_profile_argument(parser)
     parser.add_argument('stats', metavar='DATA.json', type=str,
                         help='JSON file from https://coronavirus.data.gov.uk/details/deaths')
 
     args = parser.parse_args()
+    covid.profile(args.profile)
 
-    with open(args.stats, 'r') as fd:
-        data = fd.read()
-
-    data = json.loads(data)
+    with covid.stage("load json"):
+        with open(args.stats, 'r') as fd:
+            data = fd.read()
+        data = json.loads(data)
     assert(data)
-    data = read_data(data['data'])
+    with covid.stage("read", rows=len(data['data'])):
+        data = read_data(data['data'])
     assert(data)
-    days, nations, series, data = normalize_data(data)
-    plot_data(days, nations, series, data, args)
+    with covid.stage("normalize"):
+        days, nations, series, data, filled = normalize_data(data)
+    if args.store:
+        with covid.stage("store"):
+            store_data(args.store, days, nations, data, filled)
+    with covid.stage("lockdowns"):
+        lockdowns = read_lockdowns(args)
+    with covid.stage("plot"):
+        plot_data(days, nations, series, data, lockdowns, args)
 
 
 if __name__ == "__main__":
@@ -7,13 +7,13 @@ Or use the uk_data.json file included here
 """
 
 import os
-# import dateutil
+import sys
 import argparse
-# import numpy
-import pandas
 import re
 import shelve
-import matplotlib.pyplot as plt
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import covid  # noqa: E402
 
 
 DAYS = "DAYS"
@@ -21,9 +21,28 @@ VAERS_ID = "VAERS_ID"
 VAX_DATE = "VAX_DATE"
 VAX_TYPE = "VAX_TYPE"
 ONSET_DATE = "ONSET_DATE"
+SYMPTOM = "SYMPTOM"
 REPORTS = "REPORTS"
+STATE = "STATE"
+SEX = "SEX"
+AGE_YRS = "AGE_YRS"
+VAX_DOSE_SERIES = "VAX_DOSE_SERIES"
+
+# columns read only for the stratified histograms
+STRATA_COLUMNS = {
+    "DATA": {STATE: "category", SEX: "category", AGE_YRS: "float32"},
+    "VAX": {VAX_DOSE_SERIES: "category"}
+}
+STRATA = ["vax", "age", "sex", "state", "dose", "onset", "symptom"]
+AGE_BANDS = [0, 5, 12, 18, 30, 40, 50, 65, 75, 85]
+ONSET_DAYS = 31
+UNKNOWN = "unknown"
+# refuse histograms with more cells than this
+MAX_CELLS = 1 << 28
 
 GLOBAL_OFFSET = 1
+ONSET_DPI = 135
+BOOTSTRAP_BATCH = 100  # samples per bootstrap job
 
 # Any of these symptoms count as a death
 SYMPTOMS_DEATH = {
@@ -150,20 +169,16 @@ def add_data(data, vax_type, days):
 
 
 def parse_onset(vax_data, deaths_unmatched, vax_data_csv, detail_data, symptom_data, args):
-    # compute the onset time
-    vax_date = pandas.to_datetime(detail_data[VAX_DATE])
-    onset_date = pandas.to_datetime(detail_data[ONSET_DATE])
-    onset = onset_date - vax_date
-
+    import pandas
     # add each record to vax_data
-    for vax_id, onset_i in onset.items():
+    for vax_id, onset_i in detail_data[DAYS].items():
         # ignore null dates (missing vax or onset date)
         if pandas.isnull(onset_i):
             continue
 
         # restrict reports to specific symptoms
         if args.death:
-            symptom_row = set([x.lower() for x in symptom_data.loc[vax_id] if isinstance(x, str)])
+            symptom_row = set([x for x in symptom_data.loc[vax_id] if isinstance(x, str)])
             symptom_match = symptom_row.intersection(SYMPTOMS_DEATH)
             # display symptoms matching death criteria
             # if symptom_match:
@@ -176,7 +191,7 @@ def parse_onset(vax_data, deaths_unmatched, vax_data_csv, detail_data, symptom_d
                 continue
 
         vax_type = vax_data_csv[VAX_TYPE][vax_id]
-        add_data(vax_data, vax_type, onset_i.days)
+        add_data(vax_data, vax_type, int(onset_i))
 
 
 def parse_vaxfreq(vax_data, vax_data_csv, detail_data, symptom_data, args):
@@ -184,10 +199,11 @@ def parse_vaxfreq(vax_data, vax_data_csv, detail_data, symptom_data, args):
         vax_rows = vax_data_csv
     else:
         vax_rows = vax_data_csv[vax_data_csv[VAX_TYPE].isin(args.vaxfreq)]
-    symptom_join = vax_rows.join(symptom_data.set_index(VAERS_ID), on=VAERS_ID)
+    with covid.stage("join", rows=len(vax_rows)):
+        symptom_join = vax_rows.join(symptom_data.set_index(VAERS_ID), on=VAERS_ID)
     columns = [x for x in symptom_join.keys() if re_symptoms.match(x)]
     for i, row in symptom_join[columns].iterrows():
-        row = {x.lower() for x in row if isinstance(x, str)}
+        row = {x for x in row if isinstance(x, str)}
         if args.symptoms:
             if not row.intersection(args.symptoms):
                 continue
@@ -198,37 +214,140 @@ def parse_vaxfreq(vax_data, vax_data_csv, detail_data, symptom_data, args):
             vax_data[symptom] = vax_data.get(symptom, 0) + 1
 
 
-def parse(vax_files, args):
+class Vocabulary:
+    """Append-only category dictionary shared by every frame read, so that
+    category codes mean the same thing in every file."""
+
+    def __init__(self, lower=False):
+        self.lower = lower
+        self.categories = []
+        self.index = {}
+
+    def encode(self, column):
+        """Return a categorical column as a categorical over the shared categories."""
+        import numpy
+        import pandas
+        local = column.cat.categories
+        if self.lower:
+            local = local.str.lower()
+        for category in local:
+            if category not in self.index:
+                self.index[category] = len(self.categories)
+                self.categories.append(category)
+        lookup = numpy.array([self.index[c] for c in local] + [-1], dtype=numpy.int32)
+        # code -1 (missing) picks the trailing -1
+        codes = lookup[column.cat.codes.to_numpy()]
+        return pandas.Categorical.from_codes(codes, dtype=pandas.CategoricalDtype(self.categories))
+
+
+VOCABULARY = {
+    VAX_TYPE: Vocabulary(),
+    SYMPTOM: Vocabulary(lower=True),
+    STATE: Vocabulary(),
+    SEX: Vocabulary(),
+    VAX_DOSE_SERIES: Vocabulary()
+}
+
+
+def column_type(kind, column, strata=False):
+    """Return the dtype to read a column of a VAERS file with, or None to skip it."""
+    if strata and column in STRATA_COLUMNS.get(kind, {}):
+        return STRATA_COLUMNS[kind][column]
+    if column == VAERS_ID:
+        return "int32"
+    if kind == "VAX" and column == VAX_TYPE:
+        return "category"
+    if kind == "DATA" and column in (VAX_DATE, ONSET_DATE):
+        return "str"
+    if kind == "SYMPTOMS" and re_symptoms.match(column):
+        return "category"
+    return None
+
+
+def onset_days(frame):
+    """Return the days from vaccination to onset in the smallest integer type that fits."""
+    import numpy
+    import pandas
+    vax_date = pandas.to_datetime(frame[VAX_DATE], format="%m/%d/%Y", errors="coerce")
+    onset_date = pandas.to_datetime(frame[ONSET_DATE], format="%m/%d/%Y", errors="coerce")
+    days = (onset_date - vax_date).dt.days.to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+    valid = ~numpy.isnan(days)
+    dtype = numpy.int16
+    if valid.any() and numpy.abs(days[valid]).max() > numpy.iinfo(numpy.int16).max:
+        dtype = numpy.int32
+    days = numpy.where(valid, days, 0).astype(dtype)
+    return pandas.Series(pandas.arrays.IntegerArray(days, ~valid), index=frame.index)
+
+
+def read_csv(path, strata=False):
+    """Read the columns of a VAERS CSV file that we use, in compact types:
+    int32 ids, categorical vax types and symptoms, and small int onset days.
+    With strata, also read the state, sex, age and dose columns."""
+    import pandas
+    name = os.path.basename(path)
+    kind = name.split('VAERS')[-1].split('.')[0]
+    with covid.stage("read " + name) as record:
+        header = pandas.read_csv(path, encoding='latin1', nrows=0).columns
+        dtype = {c: column_type(kind, c, strata) for c in header if column_type(kind, c, strata)}
+        frame = pandas.read_csv(path, encoding='latin1', usecols=list(dtype), dtype=dtype)
+        for column in frame.columns:
+            if dtype[column] == "category":
+                vocabulary = VOCABULARY[SYMPTOM if re_symptoms.match(column) else column]
+                frame[column] = vocabulary.encode(frame[column])
+        if kind == "DATA":
+            frame[DAYS] = onset_days(frame)
+            frame = frame.drop(columns=[VAX_DATE, ONSET_DATE])
+        record["rows"] = len(frame)
+        record["bytes_per_row"] = round(frame.memory_usage(deep=True).sum() / max(len(frame), 1), 1)
+    print(name, len(frame), "rows", record["bytes_per_row"], "bytes/row")
+    return frame
+
+
+def load(vax_files, symptoms=True, details=True, strata=False):
+    """Read each VAERSVAX file with its VAERSSYMPTOMS and VAERSDATA companions.
+    Return a list of (vax, symptom, detail) frames; skipped files are None."""
     # filter out the core vax records
     vax_files = [x for x in vax_files if x.endswith('VAERSVAX.csv')]
 
-    vax_data = {}
-    deaths_unmatched = {}
+    frames = []
 
     # for each vax file
     for vax_file in vax_files:
         # load the core vax record
-        vax_data_csv = pandas.read_csv(vax_file, encoding='latin1', low_memory=False)
+        vax_data_csv = read_csv(vax_file, strata)
 
         # infer the path to the data record
         vax_path = os.path.split(vax_file)
 
         symptom_data = None
-        if args.death or args.vaxfreq:
+        if symptoms:
             symptom_path = vax_path[-1].split('VAERS')[0]+'VAERSSYMPTOMS.csv'
             symptom_path = os.path.join(vax_path[0], symptom_path)
-            symptom_data = pandas.read_csv(symptom_path, encoding='latin1', low_memory=False)
+            symptom_data = read_csv(symptom_path)
+
+        detail_data = None
+        if details:
+            detail_path = vax_path[-1].split('VAERS')[0]+'VAERSDATA.csv'
+            detail_path = os.path.join(vax_path[0], detail_path)
+            detail_data = read_csv(detail_path, strata)
+
+        frames.append((vax_data_csv, symptom_data, detail_data))
+
+    return frames
+
 
-        detail_path = vax_path[-1].split('VAERS')[0]+'VAERSDATA.csv'
-        detail_path = os.path.join(vax_path[0], detail_path)
-        detail_data = pandas.read_csv(detail_path, encoding='latin1', low_memory=False)
-        # print(vax_data.keys())
-        # print(detail_data.keys())
+def tabulate(frames, args):
+    """Return onset counts per vaccine, or symptom frequencies with --vaxfreq."""
+    vax_data = {}
+    deaths_unmatched = {}
 
+    for vax_data_csv, symptom_data, detail_data in frames:
         if args.vaxfreq:
-            parse_vaxfreq(vax_data, vax_data_csv, detail_data, symptom_data, args)
+            with covid.stage("vaxfreq", rows=len(vax_data_csv)):
+                parse_vaxfreq(vax_data, vax_data_csv, detail_data, symptom_data, args)
         else:
-            parse_onset(vax_data, deaths_unmatched, vax_data_csv, detail_data, symptom_data, args)
+            with covid.stage("onset", rows=len(detail_data)):
+                parse_onset(vax_data, deaths_unmatched, vax_data_csv, detail_data, symptom_data, args)
 
     if deaths_unmatched:
         print("Uncounted Deathlike Events:")
@@ -238,71 +357,324 @@ def parse(vax_files, args):
     return vax_data
 
 
+def parse(vax_files, args):
+    # the symptom frequencies don't need the onset dates
+    frames = load(vax_files, symptoms=bool(args.death or args.vaxfreq), details=not args.vaxfreq)
+    return tabulate(frames, args)
+
+
+class Histogram:
+    """Report counts over named axes, with the labels of each axis."""
+
+    def __init__(self, axes, labels, counts, source=None):
+        self.axes = list(axes)
+        self.labels = [list(x) for x in labels]
+        self.counts = counts
+        self.source = source  # what the counts were built from, to validate a saved histogram
+
+    def marginal(self, axes):
+        """Return the histogram summed over every axis not in axes, in the order of axes."""
+        import numpy
+        i_axes = [self.axes.index(a) for a in axes]
+        others = tuple(i for i in range(len(self.axes)) if i not in i_axes)
+        counts = self.counts.sum(axis=others)
+        # the remaining axes keep their order; put them in the order asked for
+        kept = sorted(i_axes)
+        counts = numpy.transpose(counts, [kept.index(i) for i in i_axes])
+        return Histogram(axes, [self.labels[i] for i in i_axes], counts)
+
+    def select(self, **where):
+        """Return the slice with each named axis restricted to a label or list of labels."""
+        import numpy
+        counts = self.counts
+        labels = list(self.labels)
+        for axis, values in where.items():
+            i_axis = self.axes.index(axis)
+            values = [values] if isinstance(values, str) else values
+            for v in values:
+                if v not in labels[i_axis]:
+                    raise KeyError(f"{v} is not a label of {axis}: {' '.join(labels[i_axis])}")
+            idx = [labels[i_axis].index(v) for v in values]
+            counts = numpy.take(counts, idx, axis=i_axis)
+            labels[i_axis] = list(values)
+        return Histogram(self.axes, labels, counts)
+
+    def rows(self):
+        """Yield (labels, count) for every non-zero cell."""
+        import numpy
+        for cell in zip(*numpy.nonzero(self.counts)):
+            yield [self.labels[i][j] for i, j in enumerate(cell)], int(self.counts[cell])
+
+    def save(self, fname):
+        import json
+        import numpy
+        numpy.savez_compressed(fname, counts=self.counts,
+                               axes=json.dumps({"axes": self.axes, "labels": self.labels,
+                                                "source": self.source}))
+
+    @classmethod
+    def load(cls, fname):
+        import json
+        import numpy
+        with numpy.load(fname) as npz:
+            meta = json.loads(str(npz["axes"]))
+            return cls(meta["axes"], meta["labels"], npz["counts"], meta.get("source"))
+
+
+def category_axis(column, vocabulary):
+    """Return the codes of a categorical column in the shared vocabulary, with
+    missing values in a last "unknown" bin, and the labels."""
+    import numpy
+    codes = column.cat.codes.to_numpy().astype(numpy.int64)
+    size = len(vocabulary.categories)
+    return numpy.where(codes < 0, size, codes), vocabulary.categories + [UNKNOWN]
+
+
+def age_axis(ages):
+    """Return the age band of each age (missing ages last) and the band labels."""
+    import numpy
+    ages = ages.to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+    bands = numpy.searchsorted(AGE_BANDS, ages, side="right") - 1
+    bands = numpy.where(numpy.isnan(ages) | (bands < 0), len(AGE_BANDS), bands)
+    labels = [f"{lo}-{hi - 1}" for lo, hi in zip(AGE_BANDS, AGE_BANDS[1:])]
+    return bands, labels + [f"{AGE_BANDS[-1]}+", UNKNOWN]
+
+
+def onset_axis(days, ndays=ONSET_DAYS):
+    """Return the onset bin of each day: before vaccination, one bin per day
+    up to ndays, later, and unknown. Also return the labels."""
+    import numpy
+    valid = days.notna().to_numpy()
+    days = days.to_numpy(dtype=numpy.int64, na_value=0)
+    bins = numpy.clip(days, -1, ndays) + 1
+    bins = numpy.where(valid, bins, ndays + 2)
+    return bins, ["<0"] + [str(d) for d in range(ndays)] + [f">={ndays}", UNKNOWN]
+
+
+def symptom_pairs(symptom_data):
+    """Return a frame of (VAERS_ID, SYMPTOM code) pairs, one per symptom of each report."""
+    import numpy
+    import pandas
+    columns = [x for x in symptom_data.columns if re_symptoms.match(x)]
+    ids = numpy.tile(symptom_data[VAERS_ID].to_numpy(), len(columns))
+    codes = numpy.concatenate([symptom_data[c].cat.codes.to_numpy() for c in columns])
+    pairs = pandas.DataFrame({VAERS_ID: ids, SYMPTOM: codes.astype(numpy.int32)})
+    return pairs[pairs[SYMPTOM] >= 0].drop_duplicates()
+
+
+def histogram(frames, axes, death=False, ndays=ONSET_DAYS):
+    """Count vaccination records over the named strata (see STRATA) in one pass:
+    each record's bins are combined into one flat index and counted with bincount.
+    With the symptom axis, each record is counted once for each of its symptoms.
+    With death, only reports with a death symptom are counted."""
+    import numpy
+    counts = None
+    labels = None
+    death_codes = [i for i, x in enumerate(VOCABULARY[SYMPTOM].categories) if x in SYMPTOMS_DEATH]
+    for vax_data_csv, symptom_data, detail_data in frames:
+        with covid.stage("histogram", rows=len(vax_data_csv)):
+            rows = vax_data_csv.merge(detail_data, on=VAERS_ID, how="left")
+            if death or "symptom" in axes:
+                pairs = symptom_pairs(symptom_data)
+            if death:
+                dead = pairs.loc[pairs[SYMPTOM].isin(death_codes), VAERS_ID].unique()
+                rows = rows[rows[VAERS_ID].isin(dead)]
+            if "symptom" in axes:
+                rows = rows.merge(pairs, on=VAERS_ID)
+            bins = []
+            labels = []
+            for axis in axes:
+                if axis == "vax":
+                    b, lbl = category_axis(rows[VAX_TYPE], VOCABULARY[VAX_TYPE])
+                elif axis == "age":
+                    b, lbl = age_axis(rows[AGE_YRS])
+                elif axis == "sex":
+                    b, lbl = category_axis(rows[SEX], VOCABULARY[SEX])
+                elif axis == "state":
+                    b, lbl = category_axis(rows[STATE], VOCABULARY[STATE])
+                elif axis == "dose":
+                    b, lbl = category_axis(rows[VAX_DOSE_SERIES], VOCABULARY[VAX_DOSE_SERIES])
+                elif axis == "onset":
+                    b, lbl = onset_axis(rows[DAYS], ndays)
+                else:
+                    codes = rows[SYMPTOM].to_numpy().astype(numpy.int64)
+                    b, lbl = codes, list(VOCABULARY[SYMPTOM].categories)
+                bins.append(b)
+                labels.append(lbl)
+            # the frames are all loaded, so the vocabularies and shape are the same for every file
+            shape = tuple(len(x) for x in labels)
+            cells = int(numpy.prod(shape, dtype=numpy.int64))
+            if cells > MAX_CELLS:
+                raise ValueError(f"histogram of {shape} has too many cells; use fewer strata")
+            flat = numpy.ravel_multi_index(bins, shape) if bins else numpy.zeros(len(rows), numpy.int64)
+            file_counts = numpy.bincount(flat, minlength=cells).reshape(shape)
+            counts = file_counts if counts is None else counts + file_counts
+    return Histogram(axes, labels, counts)
+
+
+def print_histogram(hist, args):
+    """Print the marginal over --by (or --strata) of the --where slice of hist as CSV."""
+    where = {}
+    for clause in args.where or []:
+        axis, _, value = clause.partition("=")
+        where.setdefault(axis, []).append(value)
+    for axis in list(where) + (args.by or []):
+        if axis not in hist.axes:
+            sys.exit(f"{axis} is not one of the strata: {' '.join(hist.axes)}")
+    try:
+        hist = hist.select(**where)
+    except KeyError as e:
+        sys.exit(e.args[0])
+    hist = hist.marginal(args.by or args.strata)
+    print(",".join(hist.axes + ["count"]))
+    for labels, n in hist.rows():
+        print(",".join(labels + [str(n)]))
+
+
+def stratify(args):
+    """Build (or load with --hist) the histogram over --strata and print it.
+    A saved histogram is reused only if it was built from the same files with the
+    same --death and has every axis asked for."""
+    source = {"death": bool(args.death),
+              "files": sorted(os.path.abspath(x) for x in args.stats if x.endswith('VAERSVAX.csv'))}
+    if args.hist and os.path.exists(args.hist):
+        hist = Histogram.load(args.hist)
+        if hist.source == source and set(args.strata) <= set(hist.axes):
+            print("opened", args.hist, file=sys.stderr)
+            covid.count("cache hits")
+            print_histogram(hist, args)
+            return
+    frames = load(args.stats, symptoms=bool(args.death or "symptom" in args.strata),
+                  details=True, strata=True)
+    hist = histogram(frames, args.strata, death=args.death)
+    hist.source = source
+    if args.hist:
+        hist.save(args.hist)
+    print_histogram(hist, args)
+
+
+def onset_matrix(vax_data):
+    """Return the vaccine names, the day offset of column 0 and a dense
+    (vaccine x day) matrix of onset counts. The columns always include day 0."""
+    import numpy
+    names = list(vax_data.keys())
+    days_min = min(0, min(min(v.keys()) for v in vax_data.values()))
+    days_max = max(0, max(max(v.keys()) for v in vax_data.values()))
+    counts = numpy.zeros((len(names), days_max - days_min + 1), dtype=numpy.int64)
+    for row, vax_name in enumerate(names):
+        vax_onsets = vax_data[vax_name]
+        days = numpy.fromiter(vax_onsets.keys(), dtype=numpy.int64, count=len(vax_onsets))
+        counts[row, days - days_min] = numpy.fromiter(vax_onsets.values(), dtype=numpy.int64,
+                                                      count=len(vax_onsets))
+    return names, days_min, counts
+
+
+def onset_series(counts, frequency, acc=False):
+    """Return (y, mask) for every row of counts: the percentage of each vaccine's
+    reports per day (or the cumulative percentage with acc), and the points to plot.
+    Runs of zeros are reduced to their end points."""
+    import numpy
+    nonzero = counts != 0
+    if acc:
+        y = numpy.cumsum(counts, axis=1, dtype=numpy.float64)
+        total = y[:, -1:]
+        y = numpy.divide(y * 100, total, out=numpy.zeros_like(y), where=total != 0)
+        # only plot the days where the running total changes
+        return y, nonzero
+    y = 100 * counts / numpy.maximum(frequency, 1)[:, None]
+    mask = nonzero.copy()
+    mask[:, 1:] |= nonzero[:, :-1]
+    mask[:, :-1] |= nonzero[:, 1:]
+    return y, mask
+
+
+def bootstrap_batch(job):
+    """Resample one batch of a vaccine's onset histogram; run in a worker process.
+    Return the curve of each sample at the plotted points."""
+    import numpy
+    row, cells, cols, ncols, points, frequency, acc, samples, seed = job
+    rng = numpy.random.default_rng(seed)
+    # multinomial over the days with reports, as many reports as the vaccine has
+    draws = rng.multinomial(frequency, cells / frequency, size=samples)
+    inside = cols >= 0
+    onsets = numpy.zeros((samples, ncols), dtype=numpy.int64)
+    onsets[:, cols[inside]] = draws[:, inside]
+    y, _ = onset_series(onsets, numpy.full(samples, frequency), acc)
+    return row, y[:, points].astype(numpy.float32)
+
+
+def bootstrap_onset(counts, columns, selected, mask, args):
+    """Return the lower and upper --ci percent bands of the onset curve of each
+    selected vaccine at its plotted points, from --bootstrap multinomial resamples
+    of its (vaccine x day) counts. Batches of samples run in a process pool, each
+    seeded from --seed, so the bands don't depend on --jobs."""
+    import numpy
+    import concurrent.futures
+    # the plotted column of each day, or -1
+    plotted = numpy.full(counts.shape[1], -1)
+    plotted[columns] = numpy.arange(len(columns))
+    batches = [min(BOOTSTRAP_BATCH, args.bootstrap - i) for i in range(0, args.bootstrap, BOOTSTRAP_BATCH)]
+    seeds = iter(numpy.random.SeedSequence(args.seed).spawn(len(selected) * len(batches)))
+    work = []
+    for row, vax_i in enumerate(selected):
+        days = numpy.flatnonzero(counts[vax_i])
+        for samples in batches:
+            work.append((row, counts[vax_i, days], plotted[days], len(columns),
+                         numpy.flatnonzero(mask[row]), int(counts[vax_i].sum()), args.acc,
+                         samples, next(seeds)))
+    curves = [[] for _ in selected]
+    with covid.stage("bootstrap", rows=len(selected) * args.bootstrap), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for row, y in pool.map(bootstrap_batch, work):
+            curves[row].append(y)
+    tail = (100 - args.ci) / 200
+    bands = []
+    for row_curves in curves:
+        lo, hi = numpy.quantile(numpy.concatenate(row_curves), [tail, 1 - tail], axis=0)
+        bands.append((lo, hi))
+    return bands
+
+
 def plot_onset(vax_data, args):
     """Plot symptom onset frequency"""
-    days_min = 99999
-    days_max = -days_min
-    vax_frequency = {}  # records per vaccination
-
-    # count total frequency
-    for vax_name, vax_onsets in vax_data.items():
-        days_min = min(days_min, min(vax_onsets.keys()))
-        days_max = max(days_max, max(vax_onsets.keys()))
-        vax_frequency[vax_name] = sum(vax_onsets.values())
-
-    print("MIN", days_min)
-    print("MAX", days_max)
-    if args.prevax:
-        vax_onsets = range(-1, days_min - 1, -1)
-    else:
-        vax_onsets = range(0, days_max + 1)
+    import numpy
+    plt = covid.pyplot(interactive=False)
 
-    plt.figure(num=1, figsize=(8, 8))
+    names, day_0, counts = onset_matrix(vax_data)
+    frequency = counts.sum(axis=1)  # records per vaccination
+    nonzero = numpy.flatnonzero(counts.any(axis=0))
+    print("MIN", nonzero[0] + day_0)
+    print("MAX", nonzero[-1] + day_0)
 
-    ymax = 0
-    reports = 0
+    # columns counting away from the vaccination date
+    if args.prevax:
+        columns = numpy.arange(-day_0)[::-1]
+        x = numpy.arange(1, len(columns) + 1)
+    else:
+        columns = numpy.arange(-day_0, counts.shape[1])
+        x = numpy.arange(len(columns))
+    onsets = counts[:, columns]
 
     rows = args.n or 44
 
-    for row_i, (vax_name, _) in enumerate(sorted(vax_frequency.items(), reverse=True, key=lambda kv: kv[1])):
+    selected = []
+    for row_i, vax_i in enumerate(sorted(range(len(names)), reverse=True, key=lambda i: frequency[i])):
         if row_i > rows:
             break
         # skip vaccines not listed
-        if args.vax and vax_name not in args.vax:
+        if args.vax and names[vax_i] not in args.vax:
             continue
-        # get values from the row
-        vax_dt = vax_data[vax_name]
-        print(vax_frequency[vax_name], vax_name, "reports", min(vax_dt.keys()), "-", max(vax_dt.keys()), "days")
-        x = [0]
-        y = [0]
-
-        if args.acc:
-            yacc = 0
-            for i in vax_onsets:
-                yt = vax_dt.get(i, 0)
-                yacc += yt
-                if y[-1] != yacc:
-                    x.append(i)
-                    y.append(yacc)
-            reports += y[-1]
-            y = [yt / y[-1] * 100 for yt in y]
-            ymax = 100
-        else:
-            for i in vax_onsets:
-                yt = vax_dt.get(i, 0)
-                reports += yt
-                if y[-1] or yt:
-                    it = abs(i)
-                    if x and x[-1] < it - 1:
-                        x.append(it - 1)
-                        y.append(0.0)
-                    yt /= vax_frequency[vax_name]
-                    yt *= 100
-                    ymax = max(ymax, yt)
-                    x.append(it)
-                    y.append(yt)
-
-        plt.plot([i + GLOBAL_OFFSET for i in x], y, label=vax_name)
+        selected.append(vax_i)
+
+    y, mask = onset_series(onsets[selected], frequency[selected], args.acc)
+    reports = int(onsets[selected].sum())
+    ymax = 0
+    if selected:
+        ymax = 100 if args.acc else float(y.max())
+
+    for vax_i in selected:
+        vax_dt = vax_data[names[vax_i]]
+        print(frequency[vax_i], names[vax_i], "reports", min(vax_dt.keys()), "-", max(vax_dt.keys()), "days")
 
     title = "Event"
     fname = "vax_onset.png"
@@ -310,6 +682,33 @@ def plot_onset(vax_data, args):
         fname = "vax_death_onset.png"
         title = "Death"
 
+    key = covid.render_key(plot_onset, [names[i] for i in selected], onsets[selected],
+                           frequency[selected], args.prevax, args.acc, args.ylog, args.death,
+                           args.bootstrap, args.ci, args.seed)
+    if covid.rendered(fname, key):
+        return
+
+    bands = None
+    if args.bootstrap and selected:
+        bands = bootstrap_onset(counts, columns, selected, mask, args)
+        if not args.acc:
+            ymax = max(ymax, max(float(hi.max(initial=0)) for lo, hi in bands))
+
+    plt.figure(num=1, figsize=(8, 8))
+
+    # log x buckets, one per pixel of the saved chart
+    buckets = covid.axis_pixels(plt.gca(), ONSET_DPI)
+    for row, vax_i in enumerate(selected):
+        x_full = numpy.concatenate(([0], x[mask[row]])) + GLOBAL_OFFSET
+        y_row = numpy.concatenate(([0], y[row][mask[row]]))
+        x_row, y_row = covid.downsample(x_full, y_row, buckets, log=True)
+        line, = plt.plot(x_row, y_row, label=names[vax_i])
+        if bands:
+            # the band at the points kept for the line (the last point of a repeated x)
+            keep = numpy.searchsorted(x_full, x_row, side="right") - 1
+            lo, hi = (numpy.concatenate(([0], b))[keep] for b in bands[row])
+            plt.fill_between(x_row, lo, hi, color=line.get_color(), alpha=0.2, linewidth=0)
+
     plt.xscale("log")
     # enable this for log scale y
     if args.ylog:
@@ -344,7 +743,7 @@ def plot_onset(vax_data, args):
         plt.text(label_x + GLOBAL_OFFSET, ymax * yscale, label_t, color="blue", ha=ha_t)
 
     plt.subplots_adjust(left=0.07, right=.985, top=0.96, bottom=0.07)
-    plt.savefig(fname, dpi=135)
+    covid.savefig(plt, fname, key, dpi=ONSET_DPI)
 
 
 def chunk(n, chunks, lst):
@@ -354,70 +753,127 @@ def chunk(n, chunks, lst):
     return(lst[int(n * csize):int((n + 1) * csize)])
 
 
+def top_ranked(counts, rows):
+    """Return the indices of the largest counts in descending order and their dense ranks
+    (ties share a rank): every entry ranked below rows - 1, then the first ranked rows - 1.
+    Ties keep their original order."""
+    import numpy
+    last_rank = max(rows - 1, 1)
+    n = len(counts)
+    if not n:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    # grow a top-k partition until it holds last_rank distinct counts
+    k = min(n, max(rows, 1))
+    while True:
+        top = numpy.argpartition(-counts, k - 1)[:k] if k < n else numpy.arange(n)
+        distinct = numpy.unique(counts[top])[::-1]
+        if len(distinct) >= last_rank or k == n:
+            break
+        k = min(n, 2 * k)
+    threshold = distinct[min(last_rank, len(distinct)) - 1]
+    selected = numpy.flatnonzero(counts >= threshold)
+    selected = selected[numpy.lexsort((selected, -counts[selected]))]
+    ranks = numpy.cumsum(numpy.diff(counts[selected], prepend=counts[selected[0]] + 1) != 0)
+    keep = numpy.searchsorted(ranks, last_rank) + 1
+    return selected[:keep], ranks[:keep]
+
+
+def render_vaxfreq(job):
+    """Render one chunk of the symptom frequency chart; run in a worker process."""
+    fname, pos_c, labels_c, frequency_c, xmax, title, key = job
+    plt = covid.pyplot(interactive=False)
+
+    ysize = len(frequency_c) * 0.1
+
+    plt.figure(figsize=(8, ysize))
+    plt.rc('xtick', labelsize=8)
+    plt.barh(pos_c, frequency_c, align='center')
+
+    for p, f in zip(pos_c, frequency_c):
+        plt.text(f, p + 0.25, f" {f:,d}", fontsize=6)
+
+    plt.yticks(pos_c, labels_c, fontsize=6)
+    plt.xlim(0, xmax * 1.08)
+    plt.ylim((max(pos_c) + .5), -0.5)
+    plt.title(title, fontsize=11)
+    plt.subplots_adjust(left=0.32, right=.985, top=0.97, bottom=0.03)
+    plt.savefig(fname, dpi=300, metadata=covid.render_metadata(key))
+    plt.close()
+    return fname
+
+
 def plot_vaxfreq(vax_data, args):
+    import numpy
+    import concurrent.futures
     print("VAXFREQ")
     reports = vax_data[REPORTS]
     vax_data = {k: v for k, v in vax_data.items() if k != REPORTS}
 
-    pos = []
+    names = list(vax_data.keys())
+    counts = numpy.fromiter(vax_data.values(), dtype=numpy.int64, count=len(names))
+    top, ranks = top_ranked(counts, args.n)
+
+    pos = ranks.tolist()
+    frequency = counts[top].tolist()
     labels = []
-    frequency = []
-    rows = args.n
-    i = 0
-    v_last = None
-
-    # print each report to stdout
-    fd_vaxfreq = open("vaxfreq.txt", "w")
-
-    for k, v in sorted(vax_data.items(), reverse=True, key=lambda kv: kv[1]):
-        if v_last is None or v_last != v:
-            v_last = v
-            i += 1
-        pos.append(i)
-        label = SYMPTOM_EXP.get(k, k)
-        label = f"{label:s} #{i:d}"
-        labels.append(label)
-        frequency.append(v)
-        print(v, label)
-        fd_vaxfreq.write(f"{v} {label}\n")
-        if i+1 >= rows:
-            break
+    for i, k in zip(pos, top.tolist()):
+        label = SYMPTOM_EXP.get(names[k], names[k])
+        labels.append(f"{label:s} #{i:d}")
 
-    fd_vaxfreq.close()
+    # print each report to stdout and vaxfreq.txt
+    report = "".join(f"{v} {label}\n" for v, label in zip(frequency, labels))
+    print(report, end="")
+    with open("vaxfreq.txt", "w") as fd_vaxfreq:
+        fd_vaxfreq.write(report)
 
     chunks = int(round(len(labels) / args.chunksize))
+    symlist = ", ".join(args.vaxfreq)
+    title = f"{reports:,d} {symlist:s} Unverified VAERS Reports By Symptom Frequency"
 
+    work = []
     for ci in range(chunks or 1):
         pos_c = chunk(ci, chunks, pos)
         labels_c = chunk(ci, chunks, labels)
         frequency_c = chunk(ci, chunks, frequency)
 
         pos_c = [c - pos_c[0] for c in pos_c]
-
-        ysize = len(frequency_c) * 0.1
-
-        plt.figure(num=ci, figsize=(8, ysize))
-        plt.rc('xtick', labelsize=8)
-        plt.barh(pos_c, frequency_c, align='center')
-
-        for p, f in zip(pos_c, frequency_c):
-            plt.text(f, p + 0.25, f" {f:,d}", fontsize=6)
-
-        plt.yticks(pos_c, labels_c, fontsize=6)
-        plt.xlim(0, max(frequency) * 1.08)
-        plt.ylim((max(pos_c) + .5), -0.5)
-        symlist = ", ".join(args.vaxfreq)
-        title = f"{reports:,d} {symlist:s} Unverified VAERS Reports By Symptom Frequency"
-        plt.title(title, fontsize=11)
-        plt.subplots_adjust(left=0.32, right=.985, top=0.97, bottom=0.03)
-        plt.savefig("vaxfreq{0:04d}.png".format(ci + 1), dpi=300)
-        plt.close()
+        job = ("vaxfreq{0:04d}.png".format(ci + 1), pos_c, labels_c, frequency_c,
+               max(frequency), title)
+        # skip chunks already rendered from the same data
+        key = covid.render_key(render_vaxfreq, job)
+        if not covid.rendered(job[0], key):
+            work.append(job + (key,))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for _ in pool.map(render_vaxfreq, work):
+            covid.count_render("rebuilt")
+
+
+def query_service(args):
+    """Return vax_data from the resident service, or None if it isn't running
+    or has other VAERS files loaded."""
+    status = covid.query("/status")
+    if status is None:
+        return None
+    files = sorted(os.path.abspath(x) for x in args.stats if x.endswith('VAERSVAX.csv'))
+    if status.get("vaers") != files:
+        print("service at", covid.SERVICE, "has other VAERS files loaded")
+        return None
+    print("using service at", covid.SERVICE)
+    if args.vaxfreq:
+        return covid.query("/vaxfreq", vax=args.vaxfreq, symptoms=args.symptoms)
+    onset = covid.query("/onset", death=int(args.death))
+    if onset is None:
+        return None
+    # JSON keys are strings
+    return {vax_type: {int(days): n for days, n in onsets.items()} for vax_type, onsets in onset.items()}
 
 
 def main():
     parser = argparse.ArgumentParser(description="Plot VAERS onset data.")
     parser.add_argument('-n', default=400, type=int, help="show N entries")
     parser.add_argument('--chunksize', type=int, default=100, help="Chunks have N entries each")
+    parser.add_argument('--jobs', type=int, help="render chunks and run bootstrap batches in N processes")
     parser.add_argument('--symptoms', type=str, nargs="+", help="require these symptoms")
     parser.add_argument('--vaxfreq', type=str, nargs=1, help="plot symptom frequency")
     parser.add_argument('--death', action="store_true", help="deaths only")
@@ -425,25 +881,63 @@ def main():
     parser.add_argument('--prevax', action="store_true", help="show pre-vaccination reports (events before vaccination)")
     parser.add_argument('--ylog', action="store_true", help="plot Y axis in log")
     parser.add_argument('--acc', action="store_true", help="accumulate")
+    parser.add_argument('--bootstrap', metavar='N', type=int, default=0,
+                        help="shade confidence bands from N resamples of the onset counts")
+    parser.add_argument('--ci', metavar='PERCENT', type=float, default=95, help="confidence level of the bands")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for --bootstrap")
     parser.add_argument('stats', metavar='DATA.csv', type=str, nargs="+",
                         help='CSV files from https://vaers.hhs.gov/data/datasets.html')
 
+    parser.add_argument('--no-service', action="store_true", help="don't query the resident data service")
+    parser.add_argument('--strata', nargs='+', choices=STRATA,
+                        help="print report counts stratified by these axes")
+    parser.add_argument('--by', nargs='+', choices=STRATA, help="with --strata, sum over the other axes")
+    parser.add_argument('--where', action='append', metavar='AXIS=LABEL',
+                        help="with --strata, count only this label of an axis (repeatable)")
+    parser.add_argument('--hist', metavar='FILE.npz', type=str,
+                        help="with --strata, save the histogram to FILE, or reuse it if it exists")
+    covid.add_profile_argument(parser)
+
     args = parser.parse_args()
+    if not 0 < args.ci < 100:
+        parser.error("--ci must be between 0 and 100")
+    if args.bootstrap < 0:
+        parser.error("--bootstrap must not be negative")
+    covid.profile(args.profile)
+
+    if args.strata:
+        stratify(args)
+        return
+
+    vax_data = None if args.no_service else query_service(args)
+    if vax_data is not None:
+        with covid.stage("plot"):
+            if args.vaxfreq:
+                plot_vaxfreq(vax_data, args)
+            else:
+                plot_onset(vax_data, args)
+        return
 
     if args.vaxfreq:
         with shelve.open('vax_data_vaxfreq') as vax_data:
             if vax_data:
                 print("opened cache")
+                covid.count("cache hits")
             else:
-                vax_data.update(parse(args.stats, args))
-            plot_vaxfreq(vax_data, args)
+                with covid.stage("parse"):
+                    vax_data.update(parse(args.stats, args))
+            with covid.stage("plot"):
+                plot_vaxfreq(vax_data, args)
     else:
         with shelve.open('vax_data_onset') as vax_data:
             if vax_data:
                 print("opened cache")
+                covid.count("cache hits")
             else:
-                vax_data.update(parse(args.stats, args))
-            plot_onset(vax_data, args)
+                with covid.stage("parse"):
+                    vax_data.update(parse(args.stats, args))
+            with covid.stage("plot"):
+                plot_onset(vax_data, args)
 
 
 if __name__ == "__main__":